@@ -1,15 +1,51 @@
-import gzip
 import time
-import gevent
-import gevent.monkey
-from urllib import request
-
-import simplejson
+import io
+import math
+import importlib
 import codecs
+import contextlib
+import struct
+from array import array
 import sys
 import os
 import re
 
+
+class LazyModule(object):
+    # 第一次使用时才导入模块, 并把全局变量换成导入的模块, 这样只修改关注列表等不查询的命令不会加载网络相关的模块
+    def __init__(self, global_name, module_name, submodules=()):
+        self.global_name = global_name
+        self.module_name = module_name
+        self.submodules = submodules
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.module_name)
+        for submodule in self.submodules:
+            importlib.import_module(self.module_name + '.' + submodule)
+        globals()[self.global_name] = module
+        return getattr(module, attr)
+
+
+gzip = LazyModule('gzip', 'gzip')
+hashlib = LazyModule('hashlib', 'hashlib')
+asyncio = LazyModule('asyncio', 'asyncio')
+random = LazyModule('random', 'random')
+ssl = LazyModule('ssl', 'ssl')
+gevent = LazyModule('gevent', 'gevent', ('lock', 'monkey', 'queue'))
+client = LazyModule('client', 'http.client')
+request = LazyModule('request', 'urllib.request')
+parse = LazyModule('parse', 'urllib.parse')
+error = LazyModule('error', 'urllib.error')
+simplejson = LazyModule('simplejson', 'simplejson')
+copy = LazyModule('copy', 'copy')
+csv = LazyModule('csv', 'csv')
+multiprocessing = LazyModule('multiprocessing', 'multiprocessing')
+threading = LazyModule('threading', 'threading')
+zlib = LazyModule('zlib', 'zlib')
+sqlite3 = LazyModule('sqlite3', 'sqlite3')
+weakref = LazyModule('weakref', 'weakref')
+futures = LazyModule('futures', 'concurrent.futures')
+
 _headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/67.0.3396.87 Safari/537.36',
     'Content-Type': 'text/html;charset=UTF-8',
@@ -25,7 +61,33 @@ _arguments = {
     '-out_path': _argument_priority[4], '-O': _argument_priority[4],
     '-custom_row': _argument_priority[5], '-C': _argument_priority[5],
     '-tight': _argument_priority[5], '-T': _argument_priority[5],
+    '-batch_size': _argument_priority[5], '-B': _argument_priority[5],
+    '-concurrency': _argument_priority[5], '-N': _argument_priority[5],
+    '-host_limit': _argument_priority[5], '-L': _argument_priority[5],
+    '-pool_size': _argument_priority[5], '-P': _argument_priority[5],
+    '-cache_ttl': _argument_priority[5], '-E': _argument_priority[5],
+    '-refresh': _argument_priority[5], '-F': _argument_priority[5],
+    '-watch': _argument_priority[5], '-W': _argument_priority[5],
+    '-history': _argument_priority[5], '-H': _argument_priority[5],
+    '-alert': _argument_priority[5], '-Y': _argument_priority[5],
+    '-alert_sink': _argument_priority[5], '-K': _argument_priority[5],
+    '-engine': _argument_priority[5], '-M': _argument_priority[5],
+    '-timeout': _argument_priority[5], '-X': _argument_priority[5],
+    '-retry': _argument_priority[5], '-Z': _argument_priority[5],
+    '-deadline': _argument_priority[5], '-D': _argument_priority[5],
+    '-check_area_code': _argument_priority[2], '-V': _argument_priority[2],
+    '-format': _argument_priority[5], '-J': _argument_priority[5],
+    '-workers': _argument_priority[5], '-U': _argument_priority[5],
+    '-profile': _argument_priority[5], '-Q': _argument_priority[5],
+    '-import': _argument_priority[3],
+    '-sku_attr': _argument_priority[3],
+    '-export': _argument_priority[5],
+    '-budget': _argument_priority[5],
+    '-progress': _argument_priority[5],
 }
+# 只修改配置, 关注列表或者查看历史的命令. 只使用这些命令(以及 -I)时执行后直接退出, 不查询商品信息
+_manage_options = ('-gen_area_code', '-G', '-set_area_code', '-S', '-add_sku_id', '-A', '-remove_sku_id', '-R',
+                   '-check_area_code', '-V', '-history', '-H', '-import', '-export', '-sku_attr')
 _row_name_dic = {
     'price': 'price', 'P': 'price',
     'stock': 'stock', 'S': 'stock',
@@ -36,24 +98,202 @@ _row_name_dic = {
 _align_type_dic = {'price': 0, 'stock': 0, 'coupon': 0, 'name': 0, 'url': 0}
 _max_width_dic = {'price': 5, 'stock': 5, 'coupon': 6, 'name': 4, 'url': 3}
 _show_rows = ['price', 'stock', 'coupon', 'name', 'url']
+# 需要查询的信息, 默认全部查询, 命令行中由 get_fetch_fields 按输出的列和提醒规则决定
+_fetch_fields = ['price', 'stock', 'coupon', 'name']
 _area_code = '16_1315_1316_53522'
+# 需要查询库存和优惠券的所有区域, 第一个与 _area_code 相同
+_area_codes = [_area_code]
+# 多个区域时表头显示的列名
+_row_title_dic = {}
+# in_path 以 .db 结尾时, 关注的商品保存在 sqlite 中, watchlist 表每个商品一行, settings 表保存区域代码和提醒规则
+_watchlist_db = None
+# 单独设置了属性的商品 {sku_id: {'area_codes': [...], 'refresh': 秒}}, 以及只有部分商品需要查询的区域
+_sku_attr_dic = {}
+_extra_area_codes = []
 _out_path = './out.txt'
 _in_path = './in.txt'
 _tight = False
-_sku_info = {}
+# 输出格式: table 为对齐的表格, jsonl, csv 和 binary 直接按 _show_rows 逐行写出, 不计算宽度
+_out_format = 'table'
+_out_formats = ('table', 'jsonl', 'csv', 'binary')
+# 二进制格式: 文件头为 b'JDU1', 字段数(uint8) 以及每个字段名(uint8 长度 + utf-8),
+# 之后每个商品一条记录, 依次为 sku_id 和各个字段的值, 每个值为 uint16 长度 + utf-8
+_binary_magic = b'JDU1'
+_binary_length = struct.Struct('<H')
+_binary_count = struct.Struct('<B')
+# 输出到控制台时是否已经输出过 csv 和 binary 的表头
+_stdout_header_written = False
+# 每次 mgets 请求的 sku_id 数量
+_price_batch_size = 50
+# 全局最大并发数, 每个域名的最大并发数以及每秒最多发出的请求数(令牌桶), 0 表示不限速
+_max_concurrency = 64
+_host_concurrency = 16
+_host_rate = 20
+# 每个域名保留的空闲长连接数
+_host_pool_size = 8
+_max_redirects = 5
+# 各个接口的地址, 可以指向本地的模拟服务器
+_endpoint_dic = {
+    'price': 'http://p.3.cn',
+    'stock': 'https://c0.3.cn',
+    'coupon': 'https://cd.jd.com',
+    'name': 'https://item.jd.com',
+    'area': 'https://d.jd.com'
+}
+# 并发方式: gevent 或者 asyncio
+_engine = 'gevent'
+# 各个接口的超时时间(秒), 失败后的重试次数以及第一次重试前的最长等待时间(秒), 之后每次翻倍
+_timeout_dic = {'price': 5, 'stock': 5, 'coupon': 5, 'name': 10, 'area': 5}
+_max_retries = 2
+_retry_delay = 0.5
+# 同一域名连续失败 _circuit_threshold 次后, _circuit_cooldown 秒内不再向其发送请求
+_circuit_threshold = 5
+_circuit_cooldown = 30
+# 每次查询的最长运行时间(秒), 0 表示不限制
+_run_timeout = 0
+# 请求统计的耗时按对数分桶, 第 i 个桶的上限为 _latency_base ** i 毫秒
+_latency_base = 1.1
+_latency_buckets = 160
+# 为 True 时在查询结束后输出统计, _profile_path 不为 None 时同时导出为 json
+_profile = False
+_profile_path = None
+# 超过该时间(秒)没有用到的条件请求会从数据库中删除, 比如商品组合已经变化的批量价格请求
+_http_cache_ttl = 7 * 24 * 3600
+_not_modified = object()
+# 流式读取商品页面时每次读取的字节数
+_stream_chunk_size = 16384
+# 报告任务队列深度的间隔(秒), 0 表示不报告, 由 -progress 开启
+_report_interval = 0
+# 查询时使用的进程数, 大于 1 时把商品分给多个子进程分别查询
+_workers = 1
+# 每个 FetchSession 单独保存的配置, 名称为全局变量去掉前缀下划线, 默认与全局变量相同. 多进程模式下也传给子进程
+_session_config_names = ('headers', 'area_code', 'area_codes', 'extra_area_codes', 'sku_attr_dic', 'in_path',
+                         'out_format', 'fetch_fields', 'price_batch_size', 'max_concurrency', 'host_concurrency',
+                         'host_rate', 'host_pool_size', 'max_redirects', 'endpoint_dic', 'engine', 'timeout_dic',
+                         'max_retries', 'retry_delay', 'circuit_threshold', 'circuit_cooldown', 'run_timeout',
+                         'cache_ttl_dic', 'force_refresh', 'refresh_intervals', 'watch_interval', 'workers',
+                         'report_interval', 'sku_check_ttl', 'http_cache_ttl')
+# 区域树 {上级区域 id: [[区域 id, 区域名称], ...]}, 以及 {(上级区域 id, 区域 id): 区域名称} 的索引
+_area_children = None
+_area_name_dic = {}
+# 各项信息缓存的有效时间(秒), 缓存文件存放在 in_path 所在目录
+_cache_ttl_dic = {'name': 7 * 24 * 3600, 'coupon': 3600, 'price': 300, 'stock': 300}
+_force_refresh = False
+# 商品 id 的检查结果的有效时间(秒), 与商品信息一起缓存
+_sku_check_ttl = 30 * 24 * 3600
+# 持续监控模式下每轮查询的间隔(秒), 为 None 时只查询一次
+_watch_interval = None
+_watch_fields = ['price', 'stock', 'coupon']
+# 持续监控模式下平均每分钟的请求数上限, 为 None 时按 _cache_ttl_dic 刷新. 设置后按各项信息变化的频率分配刷新间隔,
+# 变化越频繁的刷新越快, 最短为 _watch_interval, 最长为 _max_refresh_interval
+_request_budget = None
+_max_refresh_interval = 24 * 3600
+# 按请求预算分配的刷新间隔 {(sku_id, field): 秒}
+_refresh_intervals = {}
+# 各项信息的变化频率 {(sku_id, field): [衰减后的变化次数, 衰减后的观察时长, 最后一次观察的时间, 最后一次观察的值]}
+_change_stats = {}
+_change_half_life = 3 * 24 * 3600
+# 估计变化频率时先假设每 _change_prior 秒变化一次, 没有观察记录的信息按此频率刷新
+_change_prior = 24 * 3600
+# 设置了提醒规则的信息在分配刷新间隔时的权重
+_alert_weight = 4
+# 历史记录: 每个商品一个文件, 每条记录为 4 个 uint32: 时间戳, 价格(分), 库存和优惠券在字符串表中的序号
+_history_record = struct.Struct('<IIII')
+_history_missing = 0xFFFFFFFF
+_history_strings = None
+_history_string_ids = {}
+# 提醒规则按字段编译成查找表 {field: {sku_id: {rule: value}}}, sku_id 为 * 时对所有商品生效
+_alert_rules = {'price': {}, 'stock': {}, 'coupon': {}}
+_alert_sinks = []
+# 命令行关注的商品
 _sku_ids = {}
 
 _TYPE_PRICE = 1
 _TYPE_STOCK = 2
 _TYPE_COUPON = 3
 _TYPE_NAME = 4
+_type_field_dic = {_TYPE_PRICE: 'price', _TYPE_STOCK: 'stock', _TYPE_COUPON: 'coupon', _TYPE_NAME: 'name'}
 
 _double_byte_rule = re.compile('<strong>([\u4e00-\u9fa5]+)</strong>|(\d+)')
+# 直接在响应的字节中查找价格, 库存和优惠券, 不需要解码和解析整个 json
+_price_id_bytes_rule = re.compile(rb'"id"\s*:\s*"(?:[^"\\_]*_)?([^"\\]*)"')
+_price_bytes_rule = re.compile(rb'"p"\s*:\s*"([^"\\]*)"')
+_stock_object_bytes_rule = re.compile(rb'"stock"\s*:\s*\{')
+_stock_desc_bytes_rule = re.compile(rb'"stockDesc"\s*:\s*("[^"\\]*(?:\\.[^"\\]*)*")?')
+_coupon_array_bytes_rule = re.compile(rb'"skuCoupon"\s*:\s*\[')
+_json_string_rule = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+# 写成转义的字母, 名称中含有时无法按字节查找
+_escaped_letter_bytes_rule = re.compile(rb'\\u00(?:4[1-9A-Fa-f]|5[0-9Aa]|6[1-9A-Fa-f]|7[0-9Aa])')
+# 除括号以外的字节, 以及除括号和引号以外的字节
+_non_bracket_bytes = bytes(byte for byte in range(0, 256) if byte not in b'[]{}')
+_non_structure_bytes = bytes(byte for byte in range(0, 256) if byte not in b'[]{}"')
+# 字符串或者括号, 字符串后面是冒号时为对象中的名称
+_json_token_rule = re.compile(rb'"([^"\\]*(?:\\.[^"\\]*)*)"(\s*:)?|[\[\]{}]')
+# 对象中字符串或数字的值
+_json_scalar_rule = re.compile(rb'\s*("[^"\\]*(?:\\.[^"\\]*)*"|-?[\d.eE+]+)')
 _product_rule = re.compile('<div class=\"p-name\">([^<]*)</div>')
+_product_tag = b'<div class="p-name">'
+_product_bytes_rule = re.compile(b'<div class="p-name">([^<]*)</div>')
 _sku_ids_rule = re.compile('https://item.jd.com/(\d+)')
 _value_behind_equality_sign_rule = re.compile('=(.*)')
 _argument_rule = re.compile('(-[_A-Za-z0-9]+)')
 _alpha_rule = re.compile('([a-zA-Z]+)')
+_alert_rule = re.compile('^(\\d+|\\*):(price<|drop>|restock$|coupon$)([\\d.]*)$')
+_in_stock_rule = re.compile('有货|现货')
+
+
+class FetchSession(object):
+    # 一组独立的查询配置和状态: 连接, 限速, 熔断, 缓存, 请求统计以及查询结果都保存在这里, 作为第一个参数传给查询用到的
+    # 函数, 不使用全局变量, 所以不同线程或事件循环中的多个 FetchSession 可以同时查询. 同一个 FetchSession 同一时间只能有一个查询.
+    # 配置默认与当前的全局变量相同, 可以用 _session_config_names 中的名称修改
+    def __init__(self, **config):
+        module = globals()
+        for name in _session_config_names:
+            setattr(self, name, copy.deepcopy(config[name] if name in config else module['_' + name]))
+        for name in config:
+            if name not in _session_config_names:
+                raise TypeError('不支持的配置: ' + name)
+        if 'area_codes' in config and 'area_code' not in config:
+            self.area_code = self.area_codes[0]
+        # 查询的商品, 每个商品的信息 {sku_id: {field: value}}, 各项信息最后一次更新的时间 {(sku_id, field): timestamp}
+        # 以及查询失败的信息 {sku_id: {field: 失败原因}}
+        self.sku_ids = {}
+        self.sku_info = {}
+        self.field_updated = {}
+        self.fetch_errors = {}
+        # 每个单元格的显示宽度 {(sku_id, field): width}, 在写入 sku_info 时计算一次, 输出表格时不再重复计算
+        self.cell_width_dic = {}
+        self.max_width_dic = dict(_max_width_dic)
+        self.cache_db = None
+        self.cache_updates = []
+        # 条件请求: {(url, 解析方式): {'etag', 'last_modified', 'hash', 'result'}}, 保存在缓存数据库中
+        # 服务器返回 304 或者内容的 hash 与上次相同时直接使用上次解析的结果. 用到某个 url 时才从数据库中读出,
+        # 每次保存缓存后清空. 没有缓存文件时只保存在这里, 超过 http_cache_ttl 没有用到的删除
+        self.http_cache_dic = {}
+        self.http_cache_updates = []
+        # 本次用到的条件请求 {(url, 解析方式): 使用时间}, 保存时更新数据库中的使用时间
+        self.http_cache_used = {}
+        # 商品 id 的检查结果 {sku_id: (是否有效, 检查时间)}
+        self.sku_check_dic = None
+        self.connection_pools = {}
+        self.host_limiters = {}
+        self.circuit_dic = {}
+        # 每个接口的请求统计 {endpoint: {...}}
+        self.profile_dic = {}
+        # asyncio 的信号量和连接与事件循环绑定, 按事件循环分开保存 {事件循环: {host: ...}},
+        # 同一个事件循环中同时进行的查询和检查共用限速器
+        self.async_host_limiters = weakref.WeakKeyDictionary()
+        self.async_pools = weakref.WeakKeyDictionary()
+
+    def close(self):
+        save_cache(self)
+        for key in self.connection_pools:
+            for conn in self.connection_pools[key]:
+                conn.close()
+        self.connection_pools.clear()
+        if self.cache_db is not None:
+            self.cache_db.close()
+            self.cache_db = None
 
 
 def get_html_encoding(headers):
@@ -67,54 +307,382 @@ def get_html_encoding(headers):
     return encoding
 
 
-def get_html_content(url):
-    global _headers
-    req = request.Request(url=url, headers=_headers)
-    page = request.urlopen(req)
-    encoding = get_html_encoding(page.headers)
-    data = page.read()
-    if page.getheader(name='Content-Encoding') == 'gzip':
+def get_url_host(url):
+    return parse.urlsplit(url).netloc
+
+
+def new_host_limiter(session, semaphore):
+    return {'semaphore': semaphore, 'tokens': float(session.host_rate), 'updated': time.time()}
+
+
+def get_host_limiter(session, host):
+    if host not in session.host_limiters:
+        session.host_limiters[host] = new_host_limiter(session, gevent.lock.BoundedSemaphore(session.host_concurrency))
+    return session.host_limiters[host]
+
+
+def take_host_token(session, limiter):
+    # 令牌桶: 每秒补充 host_rate 个令牌, 最多积攒 host_rate 个. 返回还需要等待的秒数, 0 表示已取得令牌
+    host_rate = session.host_rate
+    if host_rate <= 0:
+        return 0
+    now = time.time()
+    limiter['tokens'] = min(float(host_rate), limiter['tokens'] + (now - limiter['updated']) * host_rate)
+    limiter['updated'] = now
+    if limiter['tokens'] >= 1:
+        limiter['tokens'] -= 1
+        return 0
+    return (1 - limiter['tokens']) / host_rate
+
+
+def acquire_host_token(session, limiter):
+    while True:
+        wait = take_host_token(session, limiter)
+        if wait <= 0:
+            return
+        gevent.sleep(wait)
+
+
+def new_connection(scheme, host, timeout):
+    if scheme == 'https':
+        return client.HTTPSConnection(host, timeout=timeout)
+    return client.HTTPConnection(host, timeout=timeout)
+
+
+def get_connection(session, scheme, host, timeout):
+    pool = session.connection_pools.setdefault((scheme, host), [])
+    if pool:
+        conn = pool.pop()
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+    return new_connection(scheme, host, timeout), False
+
+
+def release_connection(session, scheme, host, conn, resp):
+    pool = session.connection_pools.setdefault((scheme, host), [])
+    if resp.will_close or len(pool) >= session.host_pool_size:
+        conn.close()
+    else:
+        pool.append(conn)
+
+
+def send_request(session, conn, path, headers=None):
+    if headers:
+        headers = dict(session.headers, **headers)
+    else:
+        headers = session.headers
+    conn.request('GET', path, headers=headers)
+    return conn.getresponse()
+
+
+def open_url(session, url, timeout, headers=None):
+    for idx in range(0, session.max_redirects + 1):
+        url_info = parse.urlsplit(url)
+        path = url_info.path or '/'
+        if url_info.query:
+            path += '?' + url_info.query
+        conn, reused = get_connection(session, url_info.scheme, url_info.netloc, timeout)
+        while True:
+            try:
+                resp = send_request(session, conn, path, headers)
+                break
+            except TimeoutError:
+                conn.close()
+                raise
+            except (client.HTTPException, OSError):
+                conn.close()
+                if not reused:
+                    raise
+                # 复用的长连接可能已经被服务器关闭, 换一个新连接重试一次, 失败时同样关闭
+                conn = new_connection(url_info.scheme, url_info.netloc, timeout)
+                reused = False
+            except BaseException:
+                conn.close()
+                raise
+        if resp.status in (301, 302, 303, 307, 308) and resp.getheader('Location') is not None:
+            resp.read()
+            release_connection(session, url_info.scheme, url_info.netloc, conn, resp)
+            url = parse.urljoin(url, resp.getheader('Location'))
+            continue
+        if resp.status >= 400:
+            resp.read()
+            release_connection(session, url_info.scheme, url_info.netloc, conn, resp)
+            raise error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+        return url_info.scheme, url_info.netloc, conn, resp
+    raise error.URLError('重定向次数过多: ' + url)
+
+
+def decompress_content(session, data, headers, endpoint=None):
+    op = time.perf_counter()
+    raw_size = len(data)
+    if headers['Content-Encoding'] == 'gzip':
         data = gzip.decompress(data)
-    data = data.decode(encoding)
+    record_transfer(session, endpoint, raw_size, len(data), time.perf_counter() - op)
     return data
 
 
-def check_redirect(url):
-    return True
-    global _headers
-    req = request.Request(url=url, headers=_headers)
-    page = request.urlopen(req)
-    return page.url != url
+def decode_html_content(session, data, headers, endpoint=None, decompressed=False):
+    if not decompressed:
+        data = decompress_content(session, data, headers, endpoint)
+    op = time.perf_counter()
+    contents = data.decode(get_html_encoding(headers))
+    get_profile(session, endpoint)['decode_time'] += time.perf_counter() - op
+    return contents
+
+
+def get_timeout(session, endpoint):
+    return session.timeout_dic.get(endpoint, 10)
+
+
+def check_circuit(session, host):
+    circuit = session.circuit_dic.get(host)
+    if circuit is not None and circuit['open_until'] > time.time():
+        raise error.URLError('域名 ' + host + ' 连续失败 ' + str(circuit['failures']) + ' 次, 暂停请求')
+
+
+def record_host_result(session, host, success):
+    circuit = session.circuit_dic.setdefault(host, {'failures': 0, 'open_until': 0})
+    if success:
+        circuit['failures'] = 0
+        circuit['open_until'] = 0
+        return
+    circuit['failures'] += 1
+    if circuit['failures'] >= session.circuit_threshold:
+        circuit['open_until'] = time.time() + session.circuit_cooldown
+
+
+def is_retryable(e):
+    # 4xx 的错误重试也没有用, 429 除外
+    if isinstance(e, error.HTTPError):
+        return e.code >= 500 or e.code == 429
+    return isinstance(e, (OSError, client.HTTPException))
+
+
+def get_retry_delay(session, attempt):
+    # 指数退避, 并在 [0, 上限] 之间随机, 避免所有请求同时重试
+    return random.uniform(0, session.retry_delay * (2 ** attempt))
+
+
+def call_with_retry(session, url, func, *args):
+    host = get_url_host(url)
+    for attempt in range(0, session.max_retries + 1):
+        check_circuit(session, host)
+        try:
+            result = func(session, *args)
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            record_host_result(session, host, False)
+            if attempt >= session.max_retries:
+                raise
+            gevent.sleep(get_retry_delay(session, attempt))
+            continue
+        record_host_result(session, host, True)
+        return result
+
+
+def get_profile(session, endpoint):
+    profile_dic = session.profile_dic
+    if endpoint not in profile_dic:
+        profile_dic[endpoint] = {
+            'requests': 0, 'errors': 0, 'timeouts': 0,
+            'latency': array('L', [0] * _latency_buckets),
+            'bytes_raw': 0, 'bytes': 0, 'decode_time': 0.0, 'parse_time': 0.0, 'reused': 0
+        }
+    return profile_dic[endpoint]
+
+
+def get_latency_bucket(seconds):
+    ms = seconds * 1000
+    if ms <= 1:
+        return 0
+    return min(_latency_buckets - 1, int(math.log(ms) / math.log(_latency_base)) + 1)
+
+
+def record_request(session, endpoint, seconds, e=None):
+    profile = get_profile(session, endpoint)
+    profile['requests'] += 1
+    profile['latency'][get_latency_bucket(seconds)] += 1
+    if e is not None:
+        profile['errors'] += 1
+        if isinstance(e, (TimeoutError, asyncio.TimeoutError)):
+            profile['timeouts'] += 1
+
+
+def record_transfer(session, endpoint, raw_size, size, seconds):
+    profile = get_profile(session, endpoint)
+    profile['bytes_raw'] += raw_size
+    profile['bytes'] += size
+    profile['decode_time'] += seconds
+
+
+def parse_content(session, endpoint, func, *contents):
+    op = time.perf_counter()
+    try:
+        return func(*contents)
+    finally:
+        get_profile(session, endpoint)['parse_time'] += time.perf_counter() - op
+
+
+def get_conditional_headers(entry):
+    headers = {}
+    if entry is None:
+        return headers
+    if entry['etag'] is not None:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified'] is not None:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def check_not_modified(session, entry, status, headers, data, endpoint):
+    # 内容没有变化时返回 True, 否则把新的校验信息写入 entry
+    if entry is None:
+        return False
+    if status == 304 or (data is not None and entry['hash'] is not None and
+                         entry['hash'] == hashlib.blake2b(data, digest_size=16).hexdigest()):
+        get_profile(session, endpoint)['reused'] += 1
+        return True
+    entry['etag'] = headers['ETag']
+    entry['last_modified'] = headers['Last-Modified']
+    entry['hash'] = None if data is None else hashlib.blake2b(data, digest_size=16).hexdigest()
+    return False
+
+
+def request_html_content(session, url, timeout, endpoint=None, entry=None, raw=False):
+    # entry 不为 None 时发送条件请求, 内容没有变化时返回 _not_modified. raw 为 True 时不解码, 返回 (内容, 编码)
+    limiter = get_host_limiter(session, get_url_host(url))
+    with limiter['semaphore']:
+        acquire_host_token(session, limiter)
+        op = time.perf_counter()
+        try:
+            scheme, host, conn, page = open_url(session, url, timeout, get_conditional_headers(entry))
+            try:
+                data = page.read()
+            except Exception:
+                conn.close()
+                raise
+        except Exception as e:
+            record_request(session, endpoint, time.perf_counter() - op, e)
+            raise
+        record_request(session, endpoint, time.perf_counter() - op)
+        release_connection(session, scheme, host, conn, page)
+    # gzip 的结果中包含时间, 解压后再比较 hash
+    data = decompress_content(session, data, page.headers, endpoint)
+    if check_not_modified(session, entry, page.status, page.headers, data, endpoint):
+        return _not_modified
+    if raw:
+        return data, get_html_encoding(page.headers)
+    return decode_html_content(session, data, page.headers, endpoint, True)
+
+
+def get_html_content(session, url, endpoint=None):
+    return call_with_retry(session, url, request_html_content, url, get_timeout(session, endpoint), endpoint)
+
+
+def get_http_cache_entry(session, url, parser):
+    key = (url, parser)
+    if session.force_refresh:
+        return {'etag': None, 'last_modified': None, 'hash': None, 'result': None}
+    if key not in session.http_cache_dic:
+        session.http_cache_dic[key] = load_http_cache_entry(session, url, parser)
+    entry = session.http_cache_dic[key]
+    if entry is None:
+        return {'etag': None, 'last_modified': None, 'hash': None, 'result': None}
+    session.http_cache_used[key] = time.time()
+    return dict(entry)
+
+
+def set_http_cache_entry(session, url, parser, entry, result):
+    # 返回本次的结果, 内容没有变化时为上次的结果
+    if result is _not_modified:
+        return entry['result']
+    entry['result'] = result
+    if entry['etag'] is None and entry['last_modified'] is None and entry['hash'] is None:
+        return result
+    session.http_cache_dic[(url, parser)] = entry
+    session.http_cache_used[(url, parser)] = time.time()
+    session.http_cache_updates.append((url, parser, entry['etag'], entry['last_modified'], entry['hash'],
+                                       simplejson.dumps(result), time.time()))
+    return result
+
+
+def get_parsed_content(session, url, endpoint, func, raw=False):
+    # raw 为 True 时 func 的参数为解压后的字节和编码
+    entry = get_http_cache_entry(session, url, func.__name__)
+    contents = call_with_retry(session, url, request_html_content, url, get_timeout(session, endpoint), endpoint,
+                               entry, raw)
+    if contents is _not_modified:
+        pass
+    elif raw:
+        contents = parse_content(session, endpoint, func, *contents)
+    else:
+        contents = parse_content(session, endpoint, func, contents)
+    return set_http_cache_entry(session, url, func.__name__, entry, contents)
 
 
 def regex_result(regex, string, find_all=False, separator=' '):
-    result = ''
+    results = []
     if find_all:
-        result_list = regex.findall(string)
-        if result_list is None:
-            return None
-        for t in result_list:
+        for t in regex.findall(string):
             for s in t:
                 if s != '':
-                    result += s + separator
+                    results.append(s)
     else:
         result_match = regex.search(string)
         if result_match is None:
             return None
         for s in result_match.groups():
             if s is not None and s != '':
-                result += s + separator
-    if result == '':
+                results.append(s)
+    if not results:
         return None
-    elif separator == '':
-        return result.strip()
-    else:
-        return result[0:-len(separator)].strip()
+    return separator.join(results).strip()
+
+
+async def async_check_sku_ids(session, sku_ids):
+    # 返回 {sku_id: 是否有效}, 先批量查询价格, 查不到价格的再用 HEAD 请求商品页面, 被重定向到其他页面的为无效
+    if session.sku_check_dic is None:
+        session.sku_check_dic = load_sku_checks(session)
+    result = {}
+    need_check = []
+    now = time.time()
+    for sku_id in sku_ids:
+        if sku_id in result:
+            continue
+        if not sku_id.isdigit():
+            result[sku_id] = False
+            continue
+        checked = session.sku_check_dic.get(sku_id)
+        if checked is not None and now - checked[1] <= session.sku_check_ttl:
+            result[sku_id] = checked[0]
+            continue
+        result[sku_id] = None
+        need_check.append(sku_id)
+    if need_check:
+        await async_probe_sku_ids(session, need_check, result)
+        checks = []
+        for sku_id in need_check:
+            if result[sku_id] is None:
+                # 网络错误等无法确定的情况不缓存, 也不阻止添加
+                print('无法检查 sku_id:', sku_id, file=sys.stderr)
+                result[sku_id] = True
+                continue
+            session.sku_check_dic[sku_id] = (result[sku_id], now)
+            checks.append((sku_id, int(result[sku_id]), now))
+        store_sku_checks(session, checks)
+    return result
+
 
+def check_sku_ids(session, sku_ids):
+    # 处理参数时还没有 monkey patch, 使用 asyncio 才能并发检查
+    return run_coroutine(async_check_sku_ids(session, sku_ids))
 
-def check_sku_id(sku_id):
-    url = 'https://item.jd.com/' + sku_id + '.html'
-    return not check_redirect(url)
+
+def check_sku_id(session, sku_id):
+    return check_sku_ids(session, [sku_id])[sku_id]
 
 
 def get_sku_id(url):
@@ -132,61 +700,385 @@ def get_value_behind_equality_sign(string):
     return regex_result(_value_behind_equality_sign_rule, string)
 
 
-def get_product_name(sku_id):
-    url = 'https://item.jd.com/' + sku_id + '.html'
-    contents = get_html_content(url)
+def search_product_name(buffer, start):
+    # 返回找到的商品名的字节以及下一次开始查找的位置
+    global _product_tag, _product_bytes_rule
+    while True:
+        idx = buffer.find(_product_tag, start)
+        if idx == -1:
+            return None, max(start, len(buffer) - len(_product_tag) + 1)
+        match = _product_bytes_rule.match(buffer, idx)
+        if match is not None:
+            return match.group(1), idx
+        if buffer.find(b'<', idx + len(_product_tag)) == -1:
+            # 标签后面的内容还没有读到
+            return None, idx
+        start = idx + 1
+
+
+def new_name_stream(headers):
+    stream = {'decompressor': None, 'buffer': bytearray(), 'start': 0, 'raw_size': 0, 'decode_time': 0.0,
+              'parse_time': 0.0}
+    if headers['Content-Encoding'] == 'gzip':
+        stream['decompressor'] = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return stream
+
+
+def feed_name_stream(stream, chunk):
+    # 每次最多解压 _stream_chunk_size 字节, 压缩率很高的页面也不会在找到商品名之后继续解压, 找到时返回商品名的字节
+    stream['raw_size'] += len(chunk)
+    decompressor = stream['decompressor']
+    while True:
+        decode_op = time.perf_counter()
+        if decompressor is None:
+            data, chunk = chunk, b''
+        else:
+            data = decompressor.decompress(chunk, _stream_chunk_size)
+            chunk = decompressor.unconsumed_tail
+        stream['buffer'] += data
+        parse_op = time.perf_counter()
+        name, stream['start'] = search_product_name(stream['buffer'], stream['start'])
+        stream['decode_time'] += parse_op - decode_op
+        stream['parse_time'] += time.perf_counter() - parse_op
+        if name is not None or not chunk:
+            return name
+
+
+def finish_name_stream(session, stream, name, encoding):
+    record_transfer(session, 'name', stream['raw_size'], len(stream['buffer']), stream['decode_time'])
+    get_profile(session, 'name')['parse_time'] += stream['parse_time']
+    if name is not None:
+        return name.decode(encoding).strip() or None
+    # 提前结束的解析失败, 退回到对整个页面做匹配
+    return parse_content(session, 'name', parse_product_name, bytes(stream['buffer']).decode(encoding))
+
+
+def get_product_name_stream(session, url, timeout, entry=None):
+    limiter = get_host_limiter(session, get_url_host(url))
+    with limiter['semaphore']:
+        acquire_host_token(session, limiter)
+        op = time.perf_counter()
+        try:
+            scheme, host, conn, page = open_url(session, url, timeout, get_conditional_headers(entry))
+        except Exception as e:
+            record_request(session, 'name', time.perf_counter() - op, e)
+            raise
+        # 只读取页面的一部分, 无法比较内容的 hash, 只使用服务器返回的 304
+        if page.status == 304:
+            page.read()
+            release_connection(session, scheme, host, conn, page)
+            record_request(session, 'name', time.perf_counter() - op)
+            check_not_modified(session, entry, 304, page.headers, None, 'name')
+            return _not_modified
+        check_not_modified(session, entry, page.status, page.headers, None, 'name')
+        stream = new_name_stream(page.headers)
+        name = None
+        try:
+            while name is None:
+                chunk = page.read(_stream_chunk_size)
+                if not chunk:
+                    break
+                name = feed_name_stream(stream, chunk)
+        except Exception as e:
+            record_request(session, 'name', time.perf_counter() - op, e)
+            raise
+        finally:
+            # 没有读完的连接无法复用
+            if page.isclosed():
+                release_connection(session, scheme, host, conn, page)
+            else:
+                conn.close()
+        record_request(session, 'name', time.perf_counter() - op)
+    return finish_name_stream(session, stream, name, get_html_encoding(page.headers))
+
+
+def get_name_url(session, sku_id):
+    return session.endpoint_dic['name'] + '/' + sku_id + '.html'
+
+
+def parse_product_name(contents):
     global _product_rule
     return regex_result(_product_rule, contents)
 
 
+def get_product_name(session, sku_id):
+    url = get_name_url(session, sku_id)
+    entry = get_http_cache_entry(session, url, get_product_name_stream.__name__)
+    try:
+        name = call_with_retry(session, url, get_product_name_stream, url, get_timeout(session, 'name'), entry)
+    except (zlib.error, UnicodeDecodeError):
+        return get_parsed_content(session, url, 'name', parse_product_name)
+    return set_http_cache_entry(session, url, get_product_name_stream.__name__, entry, name)
+
+
 def get_param_value_in_url(url, param):
     rule = re.compile('(?<=' + param + '=)(\d+)')
     return regex_result(rule, url)
 
 
-def get_product_price(sku_id):
-    url = 'http://p.3.cn/prices/mgets?skuIds=' + sku_id
-    json_resp = get_html_content(url)
-    json_obj = simplejson.loads(json_resp)
+def get_price_url(session, sku_ids):
+    return session.endpoint_dic['price'] + '/prices/mgets?skuIds=' + ','.join(sku_ids)
+
+
+def get_scan_bytes(data, encoding):
+    # gbk 等编码中汉字的第二个字节可能与 \ 或者括号相同, 但不会是 ". 括号只会出现在字符串中, 按字符串扫描时会跳过,
+    # \ 则会把后面的引号当成转义, 所以含有 \ 时先转成 utf-8 再在字节中查找.
+    # ascii 的内容用这些编码解码的结果都相同, 按 utf-8 解码最快
+    if data.isascii():
+        return data, 'utf-8'
+    if encoding.lower().replace('-', '') == 'utf8' or data.find(b'\\') == -1:
+        return data, encoding
+    return data.decode(encoding).encode('utf-8'), 'utf-8'
+
+
+def get_price_pairs(data, encoding):
+    # 价格接口返回没有嵌套的对象数组, 每个对象各有一个 id 和 p, 按顺序分别找出后一一对应, 返回 [(id, 价格)].
+    # id 去掉 J_ 前缀. 不是数组, 有对象缺少 id 或 p, 含有转义, 或者 id 不是字符串时返回 None, 需要完整解析
+    if not data.lstrip().startswith(b'[') or _escaped_letter_bytes_rule.search(data) is not None:
+        return None
+    sku_ids = _price_id_bytes_rule.findall(data)
+    prices = _price_bytes_rule.findall(data)
+    if len(sku_ids) != len(prices) or len(sku_ids) != data.count(b'{'):
+        return None
+    return list(zip([sku_id.decode(encoding) for sku_id in sku_ids], [price.decode(encoding) for price in prices]))
+
+
+def parse_product_price(data, encoding='utf-8'):
+    data, encoding = get_scan_bytes(data, encoding)
+    pairs = get_price_pairs(data, encoding)
+    if pairs is not None:
+        if len(pairs) == 0:
+            return ''
+        return pairs[0][1]
+    json_obj = simplejson.loads(data.decode(encoding))
     if len(json_obj) == 0 or 'p' not in json_obj[0]:
         return ''
     return json_obj[0]['p']
 
 
-def get_product_stock(sku_id, area_code):
-    url = 'https://c0.3.cn/stock?skuId=' + sku_id + '&area=' + area_code + '&cat=1,2,3&extraParam={"originid":"1"}'
-    json_resp = get_html_content(url)
-    json_obj = simplejson.loads(json_resp)
-    if 'stock' not in json_obj or 'stockDesc' not in json_obj['stock']:
+def get_product_price(session, sku_id):
+    return get_parsed_content(session, get_price_url(session, [sku_id]), 'price', parse_product_price, True)
+
+
+def parse_product_prices(data, encoding='utf-8'):
+    data, encoding = get_scan_bytes(data, encoding)
+    pairs = get_price_pairs(data, encoding)
+    if pairs is not None:
+        return dict(pairs)
+    prices = {}
+    for obj in simplejson.loads(data.decode(encoding)):
+        if 'id' not in obj or 'p' not in obj:
+            continue
+        # 返回的 id 形如 J_848872
+        sku_id = str(obj['id'])
+        prices[sku_id[sku_id.find('_') + 1:]] = obj['p']
+    return prices
+
+
+def get_product_prices(session, sku_ids):
+    return get_parsed_content(session, get_price_url(session, sku_ids), 'price', parse_product_prices, True)
+
+
+def split_list(items, size):
+    items = list(items)
+    size = max(size, 1)
+    return [items[idx:idx + size] for idx in range(0, len(items), size)]
+
+
+def get_stock_url(session, sku_id, area_code):
+    return session.endpoint_dic['stock'] + '/stock?skuId=' + sku_id + '&area=' + area_code + \
+        '&cat=1,2,3&extraParam={"originid":"1"}'
+
+
+def decode_json_string(fragment, encoding):
+    # fragment 为 json 字符串引号中的字节, 只有含有转义时才需要完整解析
+    if fragment.find(b'\\') == -1:
+        return fragment.decode(encoding)
+    return simplejson.loads('"' + fragment.decode(encoding) + '"')
+
+
+def decode_json_number(literal, encoding):
+    # 与 simplejson 解析后再 str 的结果相同: 字符串去掉引号, 小数按 float 格式化
+    if literal.startswith(b'"'):
+        return decode_json_string(literal[1:-1], encoding)
+    if literal.isdigit() or (literal.startswith(b'-') and literal[1:].isdigit()):
+        return literal.decode('ascii')
+    return str(float(literal))
+
+
+def get_json_depth(data, position, start=0):
+    # 从 start 开始扫描, 返回 position 处在第几层括号中. position 在字符串中, 或者在此之前括号已经全部结束时返回 None.
+    # 没有转义时只保留括号和引号, 按引号分开后奇数位置的是字符串中的括号, 引号为奇数个说明 position 在字符串中.
+    # 有转义时先去掉所有字符串, 剩下的引号说明 position 在字符串中. 最后只逐个检查括号
+    prefix = data[start:position]
+    if prefix.find(b'\\') == -1:
+        parts = prefix.translate(None, _non_structure_bytes).split(b'"')
+        if len(parts) % 2 == 0:
+            return None
+        brackets = b''.join(parts[0::2])
+    else:
+        brackets = _json_string_rule.sub(b'', prefix)
+        if brackets.find(b'"') != -1:
+            return None
+        brackets = brackets.translate(None, _non_bracket_bytes)
+    depth = 0
+    for token in brackets:
+        if token == 0x5B or token == 0x7B:
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return None
+    return depth
+
+
+def get_object_members(data, start, keys):
+    # 扫描 start 处的对象, 返回第一层中 keys 对应的值 {key: 值}, 值为字符串(带引号)或数字的字节, 是其他类型时为 None.
+    # 对象不完整或者名称含有转义时返回 None
+    members = {}
+    depth = 0
+    for token_match in _json_token_rule.finditer(data, start):
+        token = data[token_match.start()]
+        if token == 0x22:
+            if depth == 1 and token_match.group(2) is not None:
+                key = token_match.group(1)
+                if key.find(b'\\') != -1:
+                    return None
+                if key in keys:
+                    value_match = _json_scalar_rule.match(data, token_match.end())
+                    members[key] = value_match.group(1) if value_match is not None else None
+            continue
+        if token == 0x5B or token == 0x7B:
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            return members
+    return None
+
+
+def parse_stock_bytes(data, encoding):
+    # 返回 stock 对象第一层中的 stockDesc, 没有时返回 '', 格式不符合时返回 None.
+    # 只扫描 stockDesc 之前的内容, 确认 stock 在最外层, stockDesc 在 stock 的第一层.
+    # 名称中的字母写成转义时可能与 stock 或 stockDesc 相同, 直接完整解析
+    stock_match = _stock_object_bytes_rule.search(data)
+    if stock_match is None or data.count(b'"stock"') != 1 or not data.lstrip().startswith(b'{') \
+            or _escaped_letter_bytes_rule.search(data) is not None or get_json_depth(data, stock_match.start()) != 1:
+        return None
+    desc_count = data.count(b'"stockDesc"')
+    if desc_count == 0:
         return ''
+    desc_match = _stock_desc_bytes_rule.search(data, stock_match.end())
+    if desc_count != 1 or desc_match is None or desc_match.group(1) is None \
+            or get_json_depth(data, desc_match.start(), stock_match.end() - 1) != 1:
+        return None
+    return decode_json_string(desc_match.group(1)[1:-1], encoding)
+
+
+def parse_product_stock(data, encoding='utf-8'):
     global _double_byte_rule
+    # 只从字节中取出 stockDesc 这一小段解码, 很短的响应直接完整解析更快
+    data, encoding = get_scan_bytes(data, encoding)
+    desc = parse_stock_bytes(data, encoding) if len(data) >= 256 else None
+    if desc == '':
+        return ''
+    if desc is not None:
+        return regex_result(_double_byte_rule, desc, True, ':')
+    json_obj = simplejson.loads(data.decode(encoding))
+    if 'stock' not in json_obj or 'stockDesc' not in json_obj['stock']:
+        return ''
     return regex_result(_double_byte_rule, json_obj['stock']['stockDesc'], True, ':')
 
 
-def get_product_coupon(sku_id, area_code):
-    url = 'https://cd.jd.com/promotion/v2?skuId=' + sku_id + '&area=' + area_code + '&cat=1,2,3'
-    json_resp = get_html_content(url)
-    json_obj = simplejson.loads(json_resp)
-    if 'skuCoupon' not in json_obj or len(json_obj['skuCoupon']) == 0:
-        return ''
-    coupon_list = json_obj['skuCoupon']
-    result = ''
-    for info in coupon_list:
-        result += str(info['quota']) + '-' + str(info['discount']) + ', '
-    return result[:-2]
+def get_product_stock(session, sku_id, area_code):
+    return get_parsed_content(session, get_stock_url(session, sku_id, area_code), 'stock', parse_product_stock, True)
+
+
+def get_coupon_url(session, sku_id, area_code):
+    return session.endpoint_dic['coupon'] + '/promotion/v2?skuId=' + sku_id + '&area=' + area_code + '&cat=1,2,3'
+
+
+def get_json_array_objects(data, start):
+    # 从 start 处的 [ 开始逐个扫描字符串和括号, 返回数组中每个对象的 (开始, 结束) 位置.
+    # 数组不完整或者含有对象以外的元素时返回 None
+    spans = []
+    depth = 0
+    object_start = 0
+    previous_end = start + 1
+    for token_match in _json_token_rule.finditer(data, start):
+        token = data[token_match.start()]
+        if depth == 1:
+            # 第一层的元素之间只能有逗号和空白
+            if data[previous_end:token_match.start()].strip(b' \t\r\n,'):
+                return None
+            if token != 0x7B and token != 0x5D:
+                return None
+        if token == 0x22:
+            continue
+        if token == 0x5B or token == 0x7B:
+            if depth == 1:
+                object_start = token_match.start()
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            spans.append((object_start, token_match.end()))
+            previous_end = token_match.end()
+        elif depth == 0:
+            return spans
+    return None
+
+
+def parse_coupon_bytes(data, encoding):
+    # 返回优惠券列表, 格式不符合时返回 None. 只扫描 skuCoupon 之前的内容和 skuCoupon 数组, 跳过后面的促销信息
+    array_match = _coupon_array_bytes_rule.search(data)
+    if array_match is None or data.count(b'"skuCoupon"') != 1 or not data.lstrip().startswith(b'{') \
+            or _escaped_letter_bytes_rule.search(data) is not None or get_json_depth(data, array_match.start()) != 1:
+        return None
+    spans = get_json_array_objects(data, array_match.end() - 1)
+    if spans is None:
+        return None
+    coupons = []
+    for start, end in spans:
+        members = get_object_members(data, start, (b'quota', b'discount'))
+        if members is None or members.get(b'quota') is None or members.get(b'discount') is None:
+            return None
+        coupons.append(decode_json_number(members[b'quota'], encoding) + '-' +
+                       decode_json_number(members[b'discount'], encoding))
+    return coupons
+
+
+def parse_product_coupon(data, encoding='utf-8'):
+    data, encoding = get_scan_bytes(data, encoding)
+    coupons = parse_coupon_bytes(data, encoding)
+    if coupons is None:
+        json_obj = simplejson.loads(data.decode(encoding))
+        if 'skuCoupon' not in json_obj or len(json_obj['skuCoupon']) == 0:
+            return ''
+        coupons = [str(info['quota']) + '-' + str(info['discount']) for info in json_obj['skuCoupon']]
+    return ', '.join(coupons)
+
+
+def get_product_coupon(session, sku_id, area_code):
+    url = get_coupon_url(session, sku_id, area_code)
+    return get_parsed_content(session, url, 'coupon', parse_product_coupon, True)
 
 
 def get_length(string):
     length = len(string)
+    # 纯 ASCII 字符串的显示宽度就是长度, 不需要编码
+    if string.isascii():
+        return length
     utf8_length = len(string.encode('utf-8'))
     return ((utf8_length - length) >> 1) + length
 
 
 # align_type -1: left, 0: center, 1: right
-def align_string(string, width, align_type=1, fill_char=' '):
+def align_string(string, width, align_type=1, fill_char=' ', length=None):
     # 确保填充的字符长度为 1
     fill_char = fill_char[:1]
-    length = get_length(string)
+    if length is None:
+        length = get_length(string)
     if width <= length:
         return string
     if align_type == -1:
@@ -195,89 +1087,185 @@ def align_string(string, width, align_type=1, fill_char=' '):
         front = (width - length) >> 1
     else:
         front = width - length
-    front_char = ''
-    for idx in range(0, front):
-        front_char += fill_char
-    behind = width - length - front
-    behind_char = ''
-    for idx in range(0, behind):
-        behind_char += fill_char
-    return front_char + string + behind_char
-
-
-def get_area_code_info(area_id):
-    url = 'https://d.jd.com/area/get?fid=' + area_id
-    json_resp = get_html_content(url)
-    json_obj = simplejson.loads(json_resp)
-    if len(json_obj) == 0:
+    return fill_char * front + string + fill_char * (width - length - front)
+
+
+def set_cell_width(session, sku_id, field, value):
+    length = get_length(value)
+    session.cell_width_dic[(sku_id, field)] = length
+    if length > session.max_width_dic.get(field, 0):
+        session.max_width_dic[field] = length
+
+
+def get_area_tree_path():
+    global _in_path
+    if _in_path is None:
+        return None
+    return os.path.splitext(_in_path)[0] + '.area.json'
+
+
+def index_area_children(parent_area_id):
+    global _area_children, _area_name_dic
+    for area_id, name in _area_children[parent_area_id]:
+        _area_name_dic[(parent_area_id, area_id)] = name
+
+
+def load_area_tree():
+    global _area_children
+    if _area_children is not None:
+        return _area_children
+    _area_children = {}
+    area_tree_path = get_area_tree_path()
+    if area_tree_path is not None and os.path.isfile(area_tree_path):
+        with codecs.open(area_tree_path, 'r', 'utf-8') as fp:
+            _area_children = simplejson.load(fp)
+        for parent_area_id in _area_children:
+            index_area_children(parent_area_id)
+    return _area_children
+
+
+def save_area_tree():
+    area_tree_path = get_area_tree_path()
+    if area_tree_path is None or _area_children is None:
+        return False
+    tmp_path = area_tree_path + '.tmp'
+    with codecs.open(tmp_path, 'w', 'utf-8') as fp:
+        simplejson.dump(_area_children, fp, ensure_ascii=False)
+    os.replace(tmp_path, area_tree_path)
+    return True
+
+
+def get_area_url(session, area_id):
+    return session.endpoint_dic['area'] + '/area/get?fid=' + area_id
+
+
+def fetch_area_children(session, area_id, save=True):
+    store_area_children(session, area_id, get_html_content(session, get_area_url(session, area_id), 'area'), save)
+
+
+def store_area_children(session, area_id, contents, save=True):
+    area_children = load_area_tree()
+    json_obj = parse_content(session, 'area', simplejson.loads, contents)
+    children = []
+    for obj in json_obj:
+        if 'id' in obj and 'name' in obj:
+            children.append([obj['id'], obj['name']])
+    area_children[area_id] = children
+    index_area_children(area_id)
+    if save:
+        save_area_tree()
+
+
+def get_area_code_info(session, area_id):
+    area_children = load_area_tree()
+    if area_id not in area_children:
+        fetch_area_children(session, area_id)
+    if len(area_children[area_id]) == 0:
         return None
-    return json_obj
+    return [{'id': child_id, 'name': name} for child_id, name in area_children[area_id]]
 
 
-def get_area_id_name(area_id, parent_area_id=None):
+def get_area_id_name(session, area_id, parent_area_id=None):
     if parent_area_id is not None:
-        json_obj = get_area_code_info(parent_area_id)
-        int_area_id = int(area_id)
-        if len(json_obj) == 0:
+        if not area_id.isdigit():
             return None
-        for obj in json_obj:
-            if 'id' not in obj or 'name' not in obj:
-                continue
-            if int_area_id == obj['id']:
-                return obj['name']
-        return None
+        if parent_area_id not in load_area_tree():
+            fetch_area_children(session, parent_area_id)
+        global _area_name_dic
+        return _area_name_dic.get((parent_area_id, int(area_id)))
 
 
-def check_area_code(area_code):
+def check_area_code(session, area_code):
     area_ids = area_code.split('_')
     length = len(area_ids)
     if length < 2:
         return None
     area_code_info = ''
-    area_id_name = get_area_id_name(area_ids[0], '0')
+    area_id_name = get_area_id_name(session, area_ids[0], '0')
     if area_id_name is None:
         return None
     area_code_info += area_id_name
     for idx in range(0, length - 1):
-        area_id_name = get_area_id_name(area_ids[idx + 1], area_ids[idx])
+        area_id_name = get_area_id_name(session, area_ids[idx + 1], area_ids[idx])
         if area_id_name is None:
             return None
         area_code_info += '_' + area_id_name
     return area_code_info
 
 
+async def async_check_area_codes(session, area_codes):
+    # 先并发查询所有还没有缓存的上级区域, 然后不再联网逐个校验
+    area_children = load_area_tree()
+    missing_area_ids = set()
+    for area_code in area_codes:
+        area_ids = area_code.split('_')
+        for parent_area_id in ['0'] + area_ids[:-1]:
+            if parent_area_id not in area_children:
+                missing_area_ids.add(parent_area_id)
+    if missing_area_ids:
+        await async_fetch_areas(session, missing_area_ids)
+        save_area_tree()
+    result = {}
+    for area_code in area_codes:
+        result[area_code] = check_area_code(session, area_code)
+    return result
+
+
+def check_area_codes(session, area_codes):
+    # 处理参数时还没有 monkey patch, 与检查商品 id 一样使用 asyncio 才能并发
+    return run_coroutine(async_check_area_codes(session, area_codes))
+
+
 def read_sku_ids_in_file(file_path):
+    global _sku_ids
+    if is_watchlist_db(file_path):
+        for sku_id, in open_watchlist().execute('SELECT sku_id FROM watchlist'):
+            _sku_ids[sku_id] = True
+        return True
     contents = read_file(file_path, 'utf-8', True, True)
     if contents is None:
         return False
-    global _sku_ids
+    # 文件中的商品在添加时已经检查过
     for line in contents:
         sku_id = get_sku_id(line)
-        if sku_id is not None and check_sku_id(sku_id):
+        if sku_id is not None:
             _sku_ids[sku_id] = True
 
 
-def store_sku_id(new_sku_ids):
+def store_sku_id(new_sku_ids, check=True):
     global _in_path, _sku_ids
     if _in_path is None:
         return False
-    if not _sku_ids:
+    # 数据库中 sku_id 为主键, 不需要先读出所有商品来去重
+    if not _sku_ids and not is_watchlist_db(_in_path):
         read_sku_ids_in_file(_in_path)
     need_store = []
     result = True
+    valid_dic = {}
+    if check:
+        with contextlib.closing(FetchSession()) as session:
+            valid_dic = check_sku_ids(session, [sku_id for sku_id in new_sku_ids if sku_id and sku_id not in _sku_ids])
     for sku_id in new_sku_ids:
         if sku_id is None or len(sku_id) == 0:
             print('sku_id 不能为空.')
             result = False
+            continue
         if sku_id in _sku_ids:
             continue
-        if not check_sku_id(sku_id):
+        if not valid_dic.get(sku_id, True):
             print('sku_id:', sku_id, '错误')
             result = False
-        if sku_id not in _sku_ids:
-            need_store.append(sku_id)
+            continue
+        need_store.append(sku_id)
+        _sku_ids[sku_id] = True
     if len(need_store) == 0:
         return result
+    if is_watchlist_db(_in_path):
+        db = open_watchlist()
+        with db:
+            db.executemany('INSERT OR IGNORE INTO watchlist (sku_id) VALUES (?)',
+                           [(sku_id,) for sku_id in need_store])
+        return result
     with codecs.open(_in_path, 'a+', 'utf-8') as fp:
         for sku_id in need_store:
             fp.write('https://item.jd.com/' + sku_id + '.html' + os.linesep)
@@ -307,8 +1295,64 @@ def read_file(file_path, encoding='utf-8', check_writable=False, create_while_no
     return contents
 
 
+def write_file(file_path, contents, encoding='utf-8'):
+    # 先写入临时文件再替换, 写入过程中出错不会损坏原文件
+    tmp_path = file_path + '.tmp'
+    with codecs.open(tmp_path, 'w', encoding) as fp:
+        fp.writelines(contents)
+    os.replace(tmp_path, file_path)
+
+
+def is_watchlist_db(file_path):
+    return file_path is not None and file_path.lower().endswith('.db')
+
+
+def open_watchlist():
+    global _watchlist_db
+    if _watchlist_db is None:
+        _watchlist_db = sqlite3.connect(_in_path)
+        _watchlist_db.execute('CREATE TABLE IF NOT EXISTS watchlist (sku_id TEXT PRIMARY KEY, area_codes TEXT, '
+                              'alert TEXT, refresh INTEGER)')
+        _watchlist_db.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+    return _watchlist_db
+
+
+def store_watchlist_setting(key, value):
+    db = open_watchlist()
+    with db:
+        db.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (key, value))
+
+
+def load_watchlist():
+    global _area_code, _area_codes, _sku_ids, _sku_attr_dic, _extra_area_codes
+    db = open_watchlist()
+    settings = dict(db.execute('SELECT key, value FROM settings'))
+    if settings.get('area_code'):
+        _area_codes = settings['area_code'].split(',')
+        _area_code = _area_codes[0]
+    if settings.get('alert'):
+        add_alert_rules(settings['alert'])
+    for sku_id, area_codes, alert, refresh in db.execute('SELECT sku_id, area_codes, alert, refresh FROM watchlist'):
+        _sku_ids[sku_id] = True
+        if alert:
+            add_alert_rules(','.join(sku_id + ':' + rule for rule in alert.split(',')))
+        attrs = {}
+        if area_codes:
+            attrs['area_codes'] = area_codes.split(',')
+            for area_code in attrs['area_codes']:
+                if area_code not in _area_codes and area_code not in _extra_area_codes:
+                    _extra_area_codes.append(area_code)
+        if refresh is not None:
+            attrs['refresh'] = refresh
+        if attrs:
+            _sku_attr_dic[sku_id] = attrs
+    return True
+
+
 def get_info_in_file():
-    global _area_code, _sku_ids, _in_path
+    global _area_code, _area_codes, _sku_ids, _in_path
+    if is_watchlist_db(_in_path):
+        return load_watchlist()
     contents = read_file(_in_path)
     if contents is None:
         return False
@@ -316,13 +1360,343 @@ def get_info_in_file():
         sku_id = get_sku_id(string)
         if sku_id is not None:
             _sku_ids[sku_id] = True
+        elif string.startswith('alert='):
+            add_alert_rules(get_value_behind_equality_sign(string))
         else:
             area_code_tmp = get_value_behind_equality_sign(string)
             if area_code_tmp is not None:
-                _area_code = area_code_tmp
+                _area_codes = area_code_tmp.split(',')
+                _area_code = _area_codes[0]
+    return True
+
+
+def get_history_path():
+    global _in_path
+    if _in_path is None:
+        return None
+    return os.path.splitext(_in_path)[0] + '.history'
+
+
+def load_history_strings(history_path):
+    global _history_strings, _history_string_ids
+    if _history_strings is not None:
+        return
+    _history_strings = []
+    _history_string_ids = {}
+    contents = read_file(os.path.join(history_path, 'strings.txt'))
+    if contents is None:
+        return
+    for line in contents:
+        line = line.rstrip('\r\n')
+        _history_string_ids[line] = len(_history_strings)
+        _history_strings.append(line)
+
+
+def get_history_string_id(history_path, string):
+    global _history_strings, _history_string_ids
+    string = string.replace('\n', ' ').replace('\r', ' ')
+    if string not in _history_string_ids:
+        with codecs.open(os.path.join(history_path, 'strings.txt'), 'a', 'utf-8') as fp:
+            fp.write(string + '\n')
+        _history_string_ids[string] = len(_history_strings)
+        _history_strings.append(string)
+    return _history_string_ids[string]
+
+
+def get_history_string(string_id):
+    global _history_strings
+    if string_id == _history_missing:
+        return None
+    return _history_strings[string_id]
+
+
+def price_to_cents(price):
+    try:
+        cents = int(round(float(price) * 100))
+    except ValueError:
+        return _history_missing
+    # 下架的商品价格为 -1.00
+    if cents < 0 or cents >= _history_missing:
+        return _history_missing
+    return cents
+
+
+def store_history(session, since):
+    # 追加 since 之后查询过的商品的价格, 库存和优惠券
+    history_path = get_history_path()
+    if history_path is None:
+        return False
+    if not os.path.isdir(history_path):
+        os.makedirs(history_path)
+    load_history_strings(history_path)
+    global _history_record
+    for sku_id in session.sku_info:
+        updated = [session.field_updated.get((sku_id, field), 0) for field in ('price', 'stock', 'coupon')]
+        if max(updated) < since:
+            continue
+        sku_info = session.sku_info[sku_id]
+        # 没有查询的库存和优惠券记为缺失, 而不是空字符串
+        string_ids = [_history_missing, _history_missing]
+        for idx, field in enumerate(('stock', 'coupon')):
+            if field in session.fetch_fields:
+                string_ids[idx] = get_history_string_id(history_path, sku_info[field])
+        record = _history_record.pack(int(max(updated)), price_to_cents(sku_info['price']), *string_ids)
+        with open(os.path.join(history_path, sku_id + '.bin'), 'ab') as fp:
+            fp.write(record)
     return True
 
 
+def bisect_history(fp, count, timestamp):
+    # 记录按时间顺序追加, 二分查找第一条时间不早于 timestamp 的记录
+    global _history_record
+    low, high = 0, count
+    while low < high:
+        mid = (low + high) >> 1
+        fp.seek(mid * _history_record.size)
+        if struct.unpack('<I', fp.read(4))[0] < timestamp:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+
+def get_history_file(sku_id):
+    history_path = get_history_path()
+    if history_path is None:
+        return None
+    file_path = os.path.join(history_path, sku_id + '.bin')
+    if not os.path.isfile(file_path):
+        return None
+    return file_path
+
+
+def read_history_records(fp, first, last):
+    # 读出第 first 到 last 条记录, 每 4 个元素为一条记录
+    global _history_record
+    records = array('I')
+    fp.seek(first * _history_record.size)
+    records.frombytes(fp.read((last - first) * _history_record.size))
+    if sys.byteorder == 'big':
+        records.byteswap()
+    return records
+
+
+def read_history(sku_id, start=0, end=_history_missing):
+    # 返回 [start, end) 时间段内的记录
+    file_path = get_history_file(sku_id)
+    if file_path is None:
+        return array('I')
+    with open(file_path, 'rb') as fp:
+        count = os.path.getsize(file_path) // _history_record.size
+        first = bisect_history(fp, count, start)
+        last = bisect_history(fp, count, end)
+        return read_history_records(fp, first, last)
+
+
+def get_lowest_price(sku_id, days=30):
+    # 返回最近 days 天内的最低价格(分)及其时间
+    records = read_history(sku_id, int(time.time()) - days * 24 * 3600)
+    prices = records[1::4]
+    valid_prices = [price for price in prices if price != _history_missing]
+    if not valid_prices:
+        return None, None
+    lowest = min(valid_prices)
+    return lowest, records[prices.index(lowest) * 4]
+
+
+def get_price_at(sku_id, timestamp):
+    # 返回 timestamp 时刻的价格(分), 即该时刻之前最后一条有价格的记录
+    file_path = get_history_file(sku_id)
+    if file_path is None:
+        return None, None
+    with open(file_path, 'rb') as fp:
+        last = bisect_history(fp, os.path.getsize(file_path) // _history_record.size, int(timestamp) + 1)
+        while last > 0:
+            first = max(0, last - 64)
+            records = read_history_records(fp, first, last)
+            for idx in range(len(records) - 4, -1, -4):
+                if records[idx + 1] != _history_missing:
+                    return records[idx + 1], records[idx]
+            last = first
+    return None, None
+
+
+def format_history_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def format_cents(cents):
+    if cents == _history_missing:
+        return ''
+    return '%.2f' % (cents / 100)
+
+
+def get_last_history_values(sku_ids):
+    # 返回每个商品最后一条历史记录中的 (价格, 库存, 优惠券)
+    values = {}
+    history_path = get_history_path()
+    if history_path is None:
+        return values
+    load_history_strings(history_path)
+    global _history_record, _history_strings
+    for sku_id in sku_ids:
+        file_path = get_history_file(sku_id)
+        if file_path is None:
+            continue
+        count = os.path.getsize(file_path) // _history_record.size
+        if count == 0:
+            continue
+        with open(file_path, 'rb') as fp:
+            records = read_history_records(fp, count - 1, count)
+        values[sku_id] = (format_cents(records[1]), get_history_string(records[2]), get_history_string(records[3]))
+    return values
+
+
+def add_alert_rules(arg_value):
+    if arg_value is None:
+        return False
+    global _alert_rule, _alert_rules
+    result = True
+    for rule_str in arg_value.split(','):
+        rule_match = _alert_rule.match(rule_str.strip())
+        if rule_match is None:
+            print('提醒规则格式错误:', rule_str)
+            result = False
+            continue
+        sku_id, rule, value = rule_match.groups()
+        try:
+            if rule == 'price<':
+                _alert_rules['price'].setdefault(sku_id, {})['below'] = float(value)
+            elif rule == 'drop>':
+                _alert_rules['price'].setdefault(sku_id, {})['drop'] = float(value)
+            elif rule == 'restock':
+                _alert_rules['stock'].setdefault(sku_id, {})['restock'] = True
+            else:
+                _alert_rules['coupon'].setdefault(sku_id, {})['new'] = True
+        except ValueError:
+            print('提醒规则格式错误:', rule_str)
+            result = False
+    return result
+
+
+def has_alert_rules():
+    global _alert_rules
+    for field in _alert_rules:
+        if _alert_rules[field]:
+            return True
+    return False
+
+
+def get_alert_rule(field, sku_id):
+    global _alert_rules
+    rules = _alert_rules[field]
+    if sku_id not in rules:
+        return rules.get('*')
+    if '*' not in rules:
+        return rules[sku_id]
+    rule = dict(rules['*'])
+    rule.update(rules[sku_id])
+    return rule
+
+
+def get_price_value(price):
+    try:
+        value = float(price)
+    except ValueError:
+        return None
+    if value < 0:
+        return None
+    return value
+
+
+def is_in_stock(stock):
+    global _in_stock_rule
+    return _in_stock_rule.search(stock) is not None
+
+
+def check_price_alert(sku_id, rule, previous_price, price):
+    alerts = []
+    value = get_price_value(price)
+    if value is None:
+        return alerts
+    previous_value = get_price_value(previous_price) if previous_price is not None else None
+    if 'below' in rule and value < rule['below'] and (previous_value is None or previous_value >= rule['below']):
+        alerts.append('价格低于 %s: %s' % (rule['below'], price))
+    if 'drop' in rule and previous_value is not None and previous_value > 0:
+        drop = (previous_value - value) * 100 / previous_value
+        if drop > rule['drop']:
+            alerts.append('降价 %.1f%%: %s -> %s' % (drop, previous_price, price))
+    return alerts
+
+
+def check_alerts(session, previous):
+    # previous 为上一次的 {sku_id: (价格, 库存, 优惠券)}
+    if not has_alert_rules():
+        return 0
+    alert_count = 0
+    for sku_id in session.sku_info:
+        sku_info = session.sku_info[sku_id]
+        previous_values = previous.get(sku_id)
+        if previous_values == (sku_info['price'], sku_info['stock'], sku_info['coupon']):
+            continue
+        previous_price, previous_stock, previous_coupon = previous_values or (None, None, None)
+        alerts = []
+        rule = get_alert_rule('price', sku_id)
+        if rule is not None and sku_info['price'] != previous_price:
+            alerts += check_price_alert(sku_id, rule, previous_price, sku_info['price'])
+        rule = get_alert_rule('stock', sku_id)
+        if rule is not None and previous_stock is not None and is_in_stock(sku_info['stock']) \
+                and not is_in_stock(previous_stock):
+            alerts.append('到货: ' + sku_info['stock'])
+        rule = get_alert_rule('coupon', sku_id)
+        if rule is not None and previous_coupon is not None and sku_info['coupon'] != '':
+            previous_coupons = set(previous_coupon.split(', ')) if previous_coupon else set()
+            new_coupons = [coupon for coupon in sku_info['coupon'].split(', ') if coupon not in previous_coupons]
+            if new_coupons:
+                alerts.append('新优惠券: ' + ', '.join(new_coupons))
+        if alerts and sku_info['name'] == '' and 'name' not in session.fetch_fields:
+            # 没有查询商品名时, 只为需要提醒的商品单独查询
+            try:
+                sku_info['name'] = get_product_name(session, sku_id) or ''
+            except Exception as e:
+                record_fetch_error(session, sku_id, 'name', e)
+        for message in alerts:
+            send_alert({'time': int(time.time()), 'sku_id': sku_id, 'url': sku_info['url'],
+                        'name': sku_info['name'], 'message': message})
+        alert_count += len(alerts)
+    return alert_count
+
+
+def alert_to_stdout(target, alert):
+    # 以 jsonl, csv 或 binary 格式输出到控制台时, 控制台的输出中只能有记录, 提醒改为输出到 stderr
+    fp = sys.stderr if _out_path is None and _out_format != 'table' else sys.stdout
+    print('[提醒]', alert['sku_id'], alert['message'], alert['name'], file=fp)
+
+
+def alert_to_file(target, alert):
+    with codecs.open(target, 'a', 'utf-8') as fp:
+        fp.write(simplejson.dumps(alert, ensure_ascii=False) + os.linesep)
+
+
+def alert_to_webhook(target, alert):
+    req = request.Request(url=target, data=simplejson.dumps(alert).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+    request.urlopen(req, timeout=10).read()
+
+
+_alert_sink_dic = {'stdout': alert_to_stdout, 'file': alert_to_file, 'webhook': alert_to_webhook}
+
+
+def send_alert(alert):
+    global _alert_sinks
+    sinks = _alert_sinks or [('stdout', None)]
+    for sink, target in sinks:
+        try:
+            _alert_sink_dic[sink](target, alert)
+        except Exception as e:
+            print('提醒发送到', sink, '失败:', repr(e), file=sys.stderr)
+
+
 def get_argument_priority(arg_key):
     global _arguments
     if arg_key in _arguments:
@@ -330,6 +1704,17 @@ def get_argument_priority(arg_key):
     return -1
 
 
+def is_manage_only(argv):
+    options = [get_argument_option(arg_cmd) for arg_cmd in argv]
+    options = [option for option in options if option is not None and option not in ('-in_path', '-I')]
+    if not options:
+        return False
+    for option in options:
+        if option not in _manage_options:
+            return False
+    return True
+
+
 def set_in_path(arg_value):
     global _in_path
     if arg_value == 'None':
@@ -344,37 +1729,50 @@ def set_in_path(arg_value):
 
 
 def store_area_code():
-    global _area_code, _in_path
+    global _area_codes, _in_path
+    if is_watchlist_db(_in_path):
+        store_watchlist_setting('area_code', ','.join(_area_codes))
+        return True
     # 不管需不需要写入，都检查是否可以写入
     contents = read_file(_in_path, 'utf-8', True, True)
     if contents is None:
         return False
-    need_store = True
+    # 只替换区域代码所在的行, 保留文件中的商品和提醒规则
+    area_code_line = 'area_code=' + ','.join(_area_codes) + os.linesep
+    new_contents = []
+    found = False
     for line in contents:
         if -1 != line.find('area_code='):
+            if found:
+                continue
+            found = True
             tmp_area_code = get_value_behind_equality_sign(line)
-            if tmp_area_code is not None and tmp_area_code == _area_code:
-                need_store = False
-            break
-    if need_store:
-        with codecs.open(_in_path, 'w+', 'utf-8') as fp:
-            fp.write('area_code=' + _area_code + os.linesep)
+            if tmp_area_code is not None and tmp_area_code == ','.join(_area_codes):
+                return True
+            new_contents.append(area_code_line)
+            continue
+        new_contents.append(line)
+    if not found:
+        new_contents.insert(0, area_code_line)
+    write_file(_in_path, new_contents)
     return True
 
 
 def generate_area_code(arg_value=True):
     if arg_value is False:
         return False
-    global _area_code, _alpha_rule
+    global _area_code, _area_codes, _alpha_rule
     full_area_name = ''
     gen_area_code = ''
     cur_area_id = '0'
     area_name = '中国'
     while True:
-        json_obj = get_area_code_info(cur_area_id)
+        with contextlib.closing(FetchSession()) as session:
+            json_obj = get_area_code_info(session, cur_area_id)
         if json_obj is None:
             gen_area_code = gen_area_code[0:-1]
             _area_code = gen_area_code
+            _area_codes = [_area_code]
             full_area_name = full_area_name[0:-1]
             print('当前的区域为', full_area_name, '区域代码为:', _area_code)
             break
@@ -419,10 +1817,21 @@ def generate_area_code(arg_value=True):
 
 
 def set_area_code(arg_value):
-    result = check_area_code(arg_value)
-    if result and _in_path is not None:
+    if arg_value is None or len(arg_value) == 0:
+        return False
+    global _area_code, _area_codes
+    area_codes = arg_value.split(',')
+    with contextlib.closing(FetchSession()) as session:
+        area_code_infos = check_area_codes(session, area_codes)
+    for area_code in area_codes:
+        if area_code_infos[area_code] is None:
+            print('区域代码', area_code, '错误.')
+            return False
+    _area_codes = area_codes
+    _area_code = area_codes[0]
+    if _in_path is not None:
         print('存储到 in_path : ' + str(store_area_code()))
-    return result
+    return True
 
 
 def add_sku_id(arg_value):
@@ -432,27 +1841,47 @@ def add_sku_id(arg_value):
     sku_id_list = arg_value.split(',')
     result = True
     sku_ids_store = []
+    # 一次并发检查所有商品, 检查结果会缓存
+    with contextlib.closing(FetchSession()) as session:
+        valid_dic = check_sku_ids(session, sku_id_list)
     for sku_id in sku_id_list:
-        if check_sku_id(sku_id) is False:
+        if valid_dic[sku_id] is False:
             print('添加 sku_id :', sku_id, '失败.')
             result = False
             continue
         sku_ids_store.append(sku_id)
-        _sku_ids[sku_id] = True
-    if not store_sku_id(sku_ids_store) and _in_path is None:
+    # store_sku_id 会跳过已经在 _sku_ids 中的商品, 所以在写入之后再加入
+    if not store_sku_id(sku_ids_store, False) and _in_path is None:
         result = False
+    for sku_id in sku_ids_store:
+        _sku_ids[sku_id] = True
+    return result
+
+
+def show_area_codes(arg_value):
+    if arg_value is None or len(arg_value) == 0:
+        return False
+    result = True
+    with contextlib.closing(FetchSession()) as session:
+        area_code_infos = check_area_codes(session, arg_value.split(','))
+    for area_code in area_code_infos:
+        if area_code_infos[area_code] is None:
+            print(area_code, '错误.')
+            result = False
+        else:
+            print(area_code, area_code_infos[area_code])
     return result
 
 
 def set_out_path(arg_value):
-    if arg_value is None or len(arg_value):
+    if arg_value is None or not len(arg_value):
         print(arg_value, '不能为空.')
         return False
     global _out_path
     if arg_value == 'None':
         _out_path = None
         return True
-    if not check_file(arg_value, True):
+    if not check_file(arg_value, True, True):
         print('文件', arg_value, '不存在或者不可读.')
         return False
     _out_path = arg_value
@@ -465,6 +1894,8 @@ def remove_sku_id(arg_value):
     global _sku_ids, _in_path
     if _in_path is None:
         return False
+    if is_watchlist_db(_in_path):
+        return remove_watchlist_sku_ids(arg_value)
     if not _sku_ids:
         read_sku_ids_in_file(_in_path)
     result = True
@@ -482,7 +1913,7 @@ def remove_sku_id(arg_value):
     contents = read_file(_in_path, check_writable=True)
     if contents is None:
         print(_in_path, '文件不存在或者不可写.')
-        result = False
+        return False
     new_contents = []
     for line in contents:
         sku_id = get_sku_id(line)
@@ -491,11 +1922,169 @@ def remove_sku_id(arg_value):
             _sku_ids.pop(sku_id)
             continue
         new_contents.append(line)
-    with codecs.open(_in_path, 'w', 'utf-8') as fp:
-        fp.writelines(new_contents)
+    write_file(_in_path, new_contents)
+    return result
+
+
+def remove_watchlist_sku_ids(arg_value):
+    global _sku_ids, _sku_attr_dic
+    db = open_watchlist()
+    result = True
+    # 在同一个事务中删除, 中途出错时不会只删除一部分
+    with db:
+        if arg_value.find('all') != -1:
+            db.execute('DELETE FROM watchlist')
+            _sku_ids.clear()
+            _sku_attr_dic.clear()
+            print('已删除所有商品.')
+            return result
+        for sku_id in arg_value.split(','):
+            if db.execute('DELETE FROM watchlist WHERE sku_id = ?', (sku_id,)).rowcount:
+                print(sku_id, '删除成功.')
+                _sku_ids.pop(sku_id, None)
+                _sku_attr_dic.pop(sku_id, None)
+            else:
+                print(sku_id, '未找到.')
+                result = False
     return result
 
 
+def store_alert_rules(rules):
+    if is_watchlist_db(_in_path):
+        db = open_watchlist()
+        row = db.execute('SELECT value FROM settings WHERE key = ?', ('alert',)).fetchone()
+        if row is not None and row[0]:
+            rules = row[0].split(',') + rules
+        store_watchlist_setting('alert', ','.join(rules))
+        return
+    with codecs.open(_in_path, 'a', 'utf-8') as fp:
+        for rule in rules:
+            fp.write('alert=' + rule + os.linesep)
+
+
+def import_watchlist(arg_value):
+    # 从每行一个商品链接的文件中导入商品, 区域代码和提醒规则
+    global _area_code, _area_codes
+    if _in_path is None:
+        print('in_path 为 None, 无法导入.')
+        return False
+    contents = read_file(arg_value)
+    if contents is None:
+        print('文件', arg_value, '不存在或者不可读.')
+        return False
+    sku_ids = []
+    alert_rules = []
+    for line in contents:
+        sku_id = get_sku_id(line)
+        if sku_id is not None:
+            sku_ids.append(sku_id)
+        elif line.startswith('alert='):
+            alert_rules.extend(get_value_behind_equality_sign(line).split(','))
+        else:
+            area_code_tmp = get_value_behind_equality_sign(line)
+            if area_code_tmp is not None:
+                _area_codes = area_code_tmp.split(',')
+                _area_code = _area_codes[0]
+                store_area_code()
+    # 导入的是已经关注的商品, 不再检查
+    result = store_sku_id(sku_ids, False)
+    if alert_rules:
+        store_alert_rules(alert_rules)
+    print('已导入', len(sku_ids), '个商品.')
+    return result
+
+
+def get_alert_rule_strings():
+    rule_strings = []
+    for field in _alert_rules:
+        for sku_id in _alert_rules[field]:
+            rule = _alert_rules[field][sku_id]
+            if 'below' in rule:
+                rule_strings.append(sku_id + ':price<%g' % rule['below'])
+            if 'drop' in rule:
+                rule_strings.append(sku_id + ':drop>%g' % rule['drop'])
+            if 'restock' in rule:
+                rule_strings.append(sku_id + ':restock')
+            if 'new' in rule:
+                rule_strings.append(sku_id + ':coupon')
+    return rule_strings
+
+
+def export_watchlist(arg_value):
+    # 导出为每行一个商品链接的格式, 单独设置的区域和刷新间隔无法保存
+    if arg_value is None or len(arg_value) == 0:
+        return False
+    if not get_info_in_file():
+        print('读取', _in_path, '失败.')
+        return False
+    contents = ['area_code=' + ','.join(_area_codes) + os.linesep]
+    for sku_id in _sku_ids:
+        contents.append('https://item.jd.com/' + sku_id + '.html' + os.linesep)
+    for rule_string in get_alert_rule_strings():
+        contents.append('alert=' + rule_string + os.linesep)
+    write_file(arg_value, contents)
+    print('已导出', len(_sku_ids), '个商品到', arg_value)
+    if _sku_attr_dic:
+        print(len(_sku_attr_dic), '个商品单独设置的区域和刷新间隔没有导出.')
+    return True
+
+
+def set_sku_attr(arg_value):
+    # 格式为 sku_id[,sku_id...];area=区域代码,...;refresh=秒;alert=规则,..., 值为空时清除该属性
+    if arg_value is None or arg_value.find(';') == -1:
+        print('-sku_attr 格式错误.')
+        return False
+    if not is_watchlist_db(_in_path):
+        print('只有 in_path 为 .db 文件时才能单独设置商品的属性.')
+        return False
+    items = arg_value.split(';')
+    sku_ids = [sku_id for sku_id in items[0].split(',') if sku_id]
+    columns = {}
+    for item in items[1:]:
+        key, _, value = item.partition('=')
+        values = [value for value in value.split(',') if value]
+        if key == 'area':
+            with contextlib.closing(FetchSession()) as session:
+                area_code_infos = check_area_codes(session, values)
+            for area_code in values:
+                if area_code_infos[area_code] is None:
+                    print('区域代码', area_code, '错误.')
+                    return False
+            columns['area_codes'] = ','.join(values) or None
+        elif key == 'refresh':
+            refresh = None
+            if values:
+                refresh = get_positive_int(values[0], '-sku_attr 的 refresh', True)
+                if refresh is None:
+                    return False
+            columns['refresh'] = refresh
+        elif key == 'alert':
+            for rule in values:
+                if _alert_rule.match('0:' + rule) is None:
+                    print('提醒规则格式错误:', rule)
+                    return False
+            columns['alert'] = ','.join(values) or None
+        else:
+            print('-sku_attr 不支持的属性:', key)
+            return False
+    if not sku_ids or not columns:
+        print('-sku_attr 格式错误.')
+        return False
+    with contextlib.closing(FetchSession()) as session:
+        valid_dic = check_sku_ids(session, sku_ids)
+    for sku_id in sku_ids:
+        if not valid_dic[sku_id]:
+            print('sku_id:', sku_id, '错误')
+            return False
+    db = open_watchlist()
+    with db:
+        db.executemany('INSERT OR IGNORE INTO watchlist (sku_id) VALUES (?)', [(sku_id,) for sku_id in sku_ids])
+        for column in columns:
+            db.executemany('UPDATE watchlist SET ' + column + ' = ? WHERE sku_id = ?',
+                           [(columns[column], sku_id) for sku_id in sku_ids])
+    return True
+
+
 def set_show_row(arg_value):
     if arg_value is None:
         return False
@@ -512,8 +2101,238 @@ def set_show_row(arg_value):
             show_row.append(row_name)
             if tmp is not None:
                 _align_type_dic[row_name] = int(tmp[1])
-    if len(show_row) != 0:
-        _show_rows = show_row
+    if len(show_row) == 0:
+        print('-custom_row 中没有可以显示的列.')
+        return False
+    _show_rows = show_row
+    return True
+
+
+def get_positive_int(arg_value, arg_name, allow_zero=False):
+    if arg_value is None or not arg_value.isdigit() or (int(arg_value) == 0 and not allow_zero):
+        print(arg_name, '必须为正整数.')
+        return None
+    return int(arg_value)
+
+
+def set_batch_size(arg_value):
+    global _price_batch_size
+    batch_size = get_positive_int(arg_value, '-batch_size')
+    if batch_size is None:
+        return False
+    _price_batch_size = batch_size
+    return True
+
+
+def set_concurrency(arg_value):
+    global _max_concurrency
+    concurrency = get_positive_int(arg_value, '-concurrency')
+    if concurrency is None:
+        return False
+    _max_concurrency = concurrency
+    return True
+
+
+def set_pool_size(arg_value):
+    global _host_pool_size
+    pool_size = get_positive_int(arg_value, '-pool_size')
+    if pool_size is None:
+        return False
+    _host_pool_size = pool_size
+    return True
+
+
+def set_host_limit(arg_value):
+    global _host_concurrency, _host_rate
+    if arg_value is None:
+        return False
+    tmp = arg_value.split(':')
+    host_concurrency = get_positive_int(tmp[0], '-host_limit 的并发数')
+    if host_concurrency is None:
+        return False
+    _host_concurrency = host_concurrency
+    if len(tmp) > 1:
+        host_rate = get_positive_int(tmp[1], '-host_limit 的每秒请求数', True)
+        if host_rate is None:
+            return False
+        _host_rate = host_rate
+    return True
+
+
+def set_cache_ttl(arg_value):
+    if arg_value is None:
+        return False
+    global _cache_ttl_dic, _row_name_dic
+    result = True
+    for item in arg_value.split(','):
+        tmp = item.split(':')
+        if len(tmp) != 2 or tmp[0] not in _row_name_dic or _row_name_dic[tmp[0]] not in _cache_ttl_dic:
+            print('-cache_ttl 格式错误:', item)
+            result = False
+            continue
+        ttl = get_positive_int(tmp[1], '-cache_ttl 的有效时间', True)
+        if ttl is None:
+            result = False
+            continue
+        _cache_ttl_dic[_row_name_dic[tmp[0]]] = ttl
+    return result
+
+
+def set_force_refresh(arg_value=True):
+    global _force_refresh
+    _force_refresh = arg_value is not False
+    return True
+
+
+def set_watch_interval(arg_value):
+    global _watch_interval
+    watch_interval = get_positive_int(arg_value, '-watch')
+    if watch_interval is None:
+        return False
+    _watch_interval = watch_interval
+    return True
+
+
+def set_request_budget(arg_value):
+    global _request_budget
+    request_budget = get_positive_int(arg_value, '-budget')
+    if request_budget is None:
+        return False
+    _request_budget = request_budget
+    return True
+
+
+def show_history(arg_value):
+    if arg_value is None or get_history_path() is None:
+        return False
+    if arg_value.find('@') != -1:
+        sku_id, time_str = arg_value.split('@', 1)
+        timestamp = None
+        for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+            try:
+                timestamp = time.mktime(time.strptime(time_str, time_format))
+                break
+            except ValueError:
+                continue
+        if timestamp is None:
+            print('时间格式错误:', time_str)
+            return False
+        price, price_time = get_price_at(sku_id, timestamp)
+        if price is None:
+            print('商品', sku_id, '在', time_str, '之前没有价格记录.')
+            return False
+        print('商品', sku_id, '在', time_str, '的价格为: %.2f' % (price / 100), '(' + format_history_time(price_time) + ')')
+        return True
+    tmp = arg_value.split(':')
+    sku_id = tmp[0]
+    days = 30
+    if len(tmp) > 1:
+        days = get_positive_int(tmp[1], '-history 的天数')
+        if days is None:
+            return False
+    price, price_time = get_lowest_price(sku_id, days)
+    if price is None:
+        print('商品', sku_id, '最近', days, '天没有价格记录.')
+        return False
+    print('商品', sku_id, '最近', days, '天的最低价为: %.2f' % (price / 100), '(' + format_history_time(price_time) + ')')
+    return True
+
+
+def set_alert_sink(arg_value):
+    if arg_value is None:
+        return False
+    global _alert_sinks, _alert_sink_dic
+    for sink_str in arg_value.split(','):
+        tmp = sink_str.split(':', 1)
+        if tmp[0] not in _alert_sink_dic or (tmp[0] != 'stdout' and len(tmp) == 1):
+            print('-alert_sink 格式错误:', sink_str)
+            return False
+        _alert_sinks.append((tmp[0], tmp[1] if len(tmp) > 1 else None))
+    return True
+
+
+def set_engine(arg_value):
+    global _engine
+    if arg_value not in ('gevent', 'asyncio'):
+        print('-engine 只能为 gevent 或者 asyncio.')
+        return False
+    _engine = arg_value
+    return True
+
+
+def set_format(arg_value):
+    global _out_format
+    if arg_value not in _out_formats:
+        print('-format 只能为', ', '.join(_out_formats), '中的一个.')
+        return False
+    _out_format = arg_value
+    return True
+
+
+def set_timeout(arg_value):
+    if arg_value is None:
+        return False
+    global _timeout_dic, _row_name_dic
+    for item in arg_value.split(','):
+        tmp = item.split(':')
+        endpoint = tmp[0]
+        if endpoint in _row_name_dic:
+            endpoint = _row_name_dic[endpoint]
+        if len(tmp) != 2 or endpoint not in _timeout_dic:
+            print('-timeout 格式错误:', item)
+            return False
+        timeout = get_positive_int(tmp[1], '-timeout 的超时时间')
+        if timeout is None:
+            return False
+        _timeout_dic[endpoint] = timeout
+    return True
+
+
+def set_retry(arg_value):
+    global _max_retries
+    max_retries = get_positive_int(arg_value, '-retry', True)
+    if max_retries is None:
+        return False
+    _max_retries = max_retries
+    return True
+
+
+def set_profile(arg_value):
+    global _profile, _profile_path
+    _profile = True
+    if arg_value is not None and len(arg_value):
+        _profile_path = arg_value
+    return True
+
+
+def set_workers(arg_value):
+    global _workers
+    workers = get_positive_int(arg_value, '-workers')
+    if workers is None:
+        return False
+    _workers = workers
+    return True
+
+
+def set_deadline(arg_value):
+    global _run_timeout
+    run_timeout = get_positive_int(arg_value, '-deadline', True)
+    if run_timeout is None:
+        return False
+    _run_timeout = run_timeout
+    return True
+
+
+def set_progress(arg_value):
+    global _report_interval
+    if arg_value is None:
+        _report_interval = 1
+        return True
+    report_interval = get_positive_int(arg_value, '-progress')
+    if report_interval is None:
+        return False
+    _report_interval = report_interval
+    return True
 
 
 def set_tight(arg_value=True):
@@ -532,8 +2351,31 @@ _argument_option = {
     '-add_sku_id': add_sku_id, '-A': add_sku_id,
     '-out_path': set_out_path, '-O': set_out_path,
     '-remove_sku_id': remove_sku_id, '-R': remove_sku_id,
-    'custom_row': set_show_row, '-C': set_show_row,
-    '-tight': set_tight, '-T': set_tight
+    '-custom_row': set_show_row, '-C': set_show_row,
+    '-tight': set_tight, '-T': set_tight,
+    '-batch_size': set_batch_size, '-B': set_batch_size,
+    '-concurrency': set_concurrency, '-N': set_concurrency,
+    '-host_limit': set_host_limit, '-L': set_host_limit,
+    '-pool_size': set_pool_size, '-P': set_pool_size,
+    '-cache_ttl': set_cache_ttl, '-E': set_cache_ttl,
+    '-refresh': set_force_refresh, '-F': set_force_refresh,
+    '-watch': set_watch_interval, '-W': set_watch_interval,
+    '-history': show_history, '-H': show_history,
+    '-alert': add_alert_rules, '-Y': add_alert_rules,
+    '-alert_sink': set_alert_sink, '-K': set_alert_sink,
+    '-engine': set_engine, '-M': set_engine,
+    '-timeout': set_timeout, '-X': set_timeout,
+    '-retry': set_retry, '-Z': set_retry,
+    '-deadline': set_deadline, '-D': set_deadline,
+    '-check_area_code': show_area_codes, '-V': show_area_codes,
+    '-format': set_format, '-J': set_format,
+    '-workers': set_workers, '-U': set_workers,
+    '-profile': set_profile, '-Q': set_profile,
+    '-import': import_watchlist,
+    '-sku_attr': set_sku_attr,
+    '-export': export_watchlist,
+    '-budget': set_request_budget,
+    '-progress': set_progress
 }
 
 
@@ -561,39 +2403,1199 @@ def handle_argv():
     return option_result
 
 
-def get_info(type, sku_id):
-    if type == _TYPE_PRICE:
-        _sku_info[sku_id]['price'] = get_product_price(sku_id)
-        _max_width_dic['price'] = max(_max_width_dic['price'], get_length(_sku_info[sku_id]['price']))
-    elif type == _TYPE_STOCK:
-        _sku_info[sku_id]['stock'] = get_product_stock(sku_id, _area_code)
-        _max_width_dic['stock'] = max(_max_width_dic['stock'], get_length(_sku_info[sku_id]['stock']))
-    elif type == _TYPE_COUPON:
-        _sku_info[sku_id]['coupon'] = get_product_coupon(sku_id, _area_code)
-        _max_width_dic['coupon'] = max(_max_width_dic['coupon'], get_length(_sku_info[sku_id]['coupon']))
-    elif type == _TYPE_NAME:
-        _sku_info[sku_id]['name'] = get_product_name(sku_id)
-        _max_width_dic['name'] = max(_max_width_dic['name'], get_length(_sku_info[sku_id]['name']))
+def get_cache_path(session):
+    if session.in_path is None:
+        return None
+    return os.path.splitext(session.in_path)[0] + '.cache.db'
 
 
-def generate_sku_info():
-    global _sku_info, _max_width_dic
-    threads = []
+def open_cache(session):
+    if session.cache_db is None:
+        cache_path = get_cache_path(session)
+        if cache_path is None:
+            return None
+        # JDClient 可能在不同的线程中查询, 同一时间只有一个线程使用
+        db = sqlite3.connect(cache_path, check_same_thread=False)
+        db.execute('CREATE TABLE IF NOT EXISTS sku_cache (sku_id TEXT, area_code TEXT, field TEXT, '
+                   'value TEXT, updated REAL, PRIMARY KEY (sku_id, area_code, field))')
+        db.execute('CREATE TABLE IF NOT EXISTS http_cache (url TEXT, parser TEXT, etag TEXT, '
+                   'last_modified TEXT, hash TEXT, result TEXT, used REAL, PRIMARY KEY (url, parser))')
+        prune_http_cache(session, db)
+        db.execute('CREATE TABLE IF NOT EXISTS sku_check (sku_id TEXT PRIMARY KEY, valid INTEGER, updated REAL)')
+        session.cache_db = db
+    return session.cache_db
+
+
+def get_area_field(session, field, area_code):
+    # 第一个区域的库存和优惠券仍然使用 stock 和 coupon, 其他区域为 stock@区域代码
+    if area_code == session.area_code or area_code == '':
+        return field
+    return field + '@' + area_code
+
+
+def split_area_field(session, key):
+    # 返回 (field, area_code), 价格和商品名与区域无关, area_code 为空
+    if key.find('@') != -1:
+        return tuple(key.split('@', 1))
+    if key == 'stock' or key == 'coupon':
+        return key, session.area_code
+    return key, ''
+
+
+def get_all_area_codes(session):
+    return session.area_codes + session.extra_area_codes
+
+
+def get_sku_area_codes(session, sku_id):
+    attrs = session.sku_attr_dic.get(sku_id)
+    if attrs is not None and 'area_codes' in attrs:
+        return attrs['area_codes']
+    return session.area_codes
+
+
+def get_field_ttl(session, sku_id, field):
+    # 单独设置了刷新间隔的商品, 价格, 库存和优惠券使用该间隔, 其次使用按请求预算分配的间隔
+    key = (sku_id, field)
+    field = split_area_field(session, field)[0]
+    attrs = session.sku_attr_dic.get(sku_id)
+    if field != 'name' and attrs is not None and 'refresh' in attrs:
+        return attrs['refresh']
+    if key in session.refresh_intervals:
+        return session.refresh_intervals[key]
+    return session.cache_ttl_dic[field]
+
+
+def get_fetch_fields():
+    # 所有输出格式都只写出 _show_rows 中的列, 再加上提醒规则用到的信息, 其他信息不查询
+    fields = []
+    for row_name in _show_rows:
+        field = row_name.split('@', 1)[0]
+        if field in _cache_ttl_dic and field not in fields:
+            fields.append(field)
+    for field in _alert_rules:
+        if _alert_rules[field] and field not in fields:
+            fields.append(field)
+    return fields
+
+
+def init_area_fields(session):
+    # 多个区域时, 把要显示的库存和优惠券按区域展开成多列
+    global _show_rows, _watch_fields, _row_title_dic, _align_type_dic
+    area_codes = get_all_area_codes(session)
+    if len(area_codes) <= 1:
+        return
+    show_rows = []
+    for row_name in _show_rows:
+        if row_name != 'stock' and row_name != 'coupon':
+            show_rows.append(row_name)
+            continue
+        for area_code in area_codes:
+            key = get_area_field(session, row_name, area_code)
+            show_rows.append(key)
+            _row_title_dic[key] = row_name + '@' + area_code
+            _align_type_dic[key] = _align_type_dic[row_name]
+            session.max_width_dic[key] = max(session.max_width_dic.get(key, 0), get_length(_row_title_dic[key]))
+    _show_rows = show_rows
+    for field in ('stock', 'coupon'):
+        for area_code in area_codes[1:]:
+            _watch_fields.append(get_area_field(session, field, area_code))
+
+
+def load_cache(session):
+    # 一次读出所有未过期的缓存, 返回 {(sku_id, field): (value, updated)}
+    cached = {}
+    if session.force_refresh:
+        return cached
+    db = open_cache(session)
+    if db is None:
+        return cached
+    now = time.time()
+    for sku_id, area_code, field, value, updated in db.execute('SELECT * FROM sku_cache'):
+        if sku_id not in session.sku_ids or field not in session.cache_ttl_dic:
+            continue
+        if field == 'stock' or field == 'coupon':
+            if area_code not in session.area_codes and area_code not in session.extra_area_codes:
+                continue
+        elif area_code != '':
+            continue
+        if now - updated <= get_field_ttl(session, sku_id, field):
+            cached[(sku_id, get_area_field(session, field, area_code))] = (value, updated)
+    return cached
 
-    for sku_id in _sku_ids:
-        _sku_info[sku_id] = {
-            'url': 'https://item.jd.com/' + sku_id + '.html',
-            'price': '',
-            'stock': '',
-            'coupon': '',
-            'name': ''
+
+def prune_http_cache(session, db):
+    # 旧版本的缓存没有使用时间, 从现在开始计算. 超过 http_cache_ttl 没有用到的条件请求直接删除
+    now = time.time()
+    with db:
+        if 'used' not in [row[1] for row in db.execute('PRAGMA table_info(http_cache)')]:
+            db.execute('ALTER TABLE http_cache ADD COLUMN used REAL')
+            db.execute('UPDATE http_cache SET used = ?', (now,))
+        db.execute('DELETE FROM http_cache WHERE used < ?', (now - session.http_cache_ttl,))
+
+
+def load_http_cache_entry(session, url, parser):
+    db = open_cache(session)
+    if db is None:
+        return None
+    row = db.execute('SELECT etag, last_modified, hash, result FROM http_cache WHERE url = ? AND parser = ?',
+                     (url, parser)).fetchone()
+    if row is None:
+        return None
+    return {'etag': row[0], 'last_modified': row[1], 'hash': row[2], 'result': simplejson.loads(row[3])}
+
+
+def load_sku_checks(session):
+    sku_checks = {}
+    db = open_cache(session)
+    if db is None:
+        return sku_checks
+    for sku_id, valid, updated in db.execute('SELECT * FROM sku_check'):
+        sku_checks[sku_id] = (bool(valid), updated)
+    return sku_checks
+
+
+def store_sku_checks(session, checks):
+    db = open_cache(session)
+    if db is None or not checks:
+        return
+    with db:
+        db.executemany('INSERT OR REPLACE INTO sku_check VALUES (?, ?, ?)', checks)
+
+
+def evict_http_cache(session):
+    # 没有缓存文件时条件请求只保存在内存中, 与数据库一样删除超过 http_cache_ttl 没有用到的
+    expired = time.time() - session.http_cache_ttl
+    for key in [key for key in session.http_cache_dic if session.http_cache_used.get(key, 0) < expired]:
+        del session.http_cache_dic[key]
+        session.http_cache_used.pop(key, None)
+
+
+def save_cache(session):
+    db = open_cache(session)
+    if db is None:
+        session.cache_updates = []
+        session.http_cache_updates = []
+        evict_http_cache(session)
+        return
+    # 条件请求都在数据库中(更新的部分在 http_cache_updates 中), 内存中不再保留, 下次用到时再读出,
+    # 长时间监控时不会越积越多
+    session.http_cache_dic = {}
+    if not (session.cache_updates or session.http_cache_updates or session.http_cache_used):
+        return
+    db.executemany('INSERT OR REPLACE INTO sku_cache VALUES (?, ?, ?, ?, ?)', session.cache_updates)
+    db.executemany('UPDATE http_cache SET used = ? WHERE url = ? AND parser = ?',
+                   [(used, url, parser) for (url, parser), used in session.http_cache_used.items()])
+    db.executemany('INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?, ?, ?, ?, ?)', session.http_cache_updates)
+    db.commit()
+    session.cache_updates = []
+    session.http_cache_updates = []
+    session.http_cache_used = {}
+
+
+def get_error_message(e):
+    if isinstance(e, str):
+        return e
+    return e.__class__.__name__ + ': ' + str(e)
+
+
+def record_fetch_error(session, sku_id, field, e):
+    session.fetch_errors.setdefault(sku_id, {})[field] = get_error_message(e)
+
+
+def record_unfinished(session, plans, price_sku_ids, since):
+    # 超过运行时间限制而没有完成的查询也记为失败
+    plans = plans + [(_TYPE_PRICE, sku_id, '') for sku_id in price_sku_ids]
+    for type, sku_id, area_code in plans:
+        field = get_area_field(session, _type_field_dic[type], area_code)
+        if session.field_updated.get((sku_id, field), 0) < since and \
+                field not in session.fetch_errors.get(sku_id, {}):
+            record_fetch_error(session, sku_id, field, '超过运行时间限制')
+
+
+def get_latency_percentile(latency, percent):
+    # 返回所在桶的上限(毫秒)
+    total = sum(latency)
+    if total == 0:
+        return 0
+    count = 0
+    for idx in range(0, len(latency)):
+        count += latency[idx]
+        if count * 100 >= total * percent:
+            return _latency_base ** idx
+    return _latency_base ** (len(latency) - 1)
+
+
+def merge_profile(session, profile_dic):
+    for endpoint in profile_dic:
+        profile = get_profile(session, endpoint)
+        for key in profile_dic[endpoint]:
+            if key == 'latency':
+                for idx, count in enumerate(profile_dic[endpoint][key]):
+                    profile[key][idx] += count
+            else:
+                profile[key] += profile_dic[endpoint][key]
+
+
+def get_profile_report(session, wall_time):
+    endpoints = {}
+    for endpoint in session.profile_dic:
+        profile = session.profile_dic[endpoint]
+        latency = profile['latency']
+        endpoints[str(endpoint)] = {
+            'requests': profile['requests'], 'errors': profile['errors'], 'timeouts': profile['timeouts'],
+            'p50_ms': get_latency_percentile(latency, 50), 'p95_ms': get_latency_percentile(latency, 95),
+            'p99_ms': get_latency_percentile(latency, 99),
+            'bytes_raw': profile['bytes_raw'], 'bytes': profile['bytes'],
+            'decode_time': profile['decode_time'], 'parse_time': profile['parse_time'], 'reused': profile['reused'],
+            'latency_histogram': {'%.1f' % (_latency_base ** idx): latency[idx]
+                                  for idx in range(0, len(latency)) if latency[idx]}
         }
-        _max_width_dic['url'] = max(_max_width_dic['url'], get_length(_sku_info[sku_id]['url']))
-        threads.append(gevent.spawn(get_info, _TYPE_PRICE, sku_id))
-        threads.append(gevent.spawn(get_info, _TYPE_STOCK, sku_id))
-        threads.append(gevent.spawn(get_info, _TYPE_COUPON, sku_id))
-        threads.append(gevent.spawn(get_info, _TYPE_NAME, sku_id))
-    gevent.joinall(threads)
+    return {'wall_time': wall_time, 'endpoints': endpoints, 'errors': session.fetch_errors}
+
+
+def print_profile(session, wall_time):
+    report = get_profile_report(session, wall_time)
+    titles = ['接口', '请求数', '失败', '超时', 'p50(ms)', 'p95(ms)', 'p99(ms)', '传输(KB)', '解压后(KB)', '解码(s)',
+              '解析(s)', '未变化']
+    widths = [8, 8, 6, 6, 9, 9, 9, 11, 11, 8, 8, 6]
+    print(' '.join(align_string(titles[idx], widths[idx], -1 if idx == 0 else 1) for idx in range(0, len(titles))),
+          file=sys.stderr)
+    for endpoint in report['endpoints']:
+        profile = report['endpoints'][endpoint]
+        print('%-8s %8d %6d %6d %9.1f %9.1f %9.1f %11.1f %11.1f %8.3f %8.3f %6d' % (
+            endpoint, profile['requests'], profile['errors'], profile['timeouts'], profile['p50_ms'],
+            profile['p95_ms'], profile['p99_ms'], profile['bytes_raw'] / 1024, profile['bytes'] / 1024,
+            profile['decode_time'], profile['parse_time'], profile['reused']), file=sys.stderr)
+    if _profile_path is not None:
+        with codecs.open(_profile_path, 'w', 'utf-8') as fp:
+            simplejson.dump(report, fp, ensure_ascii=False, indent=2)
+        print('统计信息已导出到', _profile_path, file=sys.stderr)
+
+
+def print_fetch_errors(session, limit=10):
+    fetch_errors = session.fetch_errors
+    errors = []
+    for sku_id in fetch_errors:
+        for field in fetch_errors[sku_id]:
+            errors.append((sku_id, field, fetch_errors[sku_id][field]))
+    if not errors:
+        return
+    print('查询失败的信息共', len(errors), '项:', file=sys.stderr)
+    for sku_id, field, message in errors[:limit]:
+        print(' ', sku_id, field, message, file=sys.stderr)
+    if len(errors) > limit:
+        print('  ...', file=sys.stderr)
+
+
+def set_sku_info(session, sku_id, field, value, updated=None):
+    fetch_errors = session.fetch_errors
+    if sku_id in fetch_errors:
+        fetch_errors[sku_id].pop(field, None)
+        if not fetch_errors[sku_id]:
+            fetch_errors.pop(sku_id)
+    if value is None:
+        value = ''
+    session.sku_info[sku_id][field] = value
+    if session.out_format == 'table':
+        set_cell_width(session, sku_id, field, value)
+    if updated is None:
+        updated = time.time()
+        if value != '':
+            base_field, area_code = split_area_field(session, field)
+            session.cache_updates.append((sku_id, area_code, base_field, value, updated))
+    session.field_updated[(sku_id, field)] = updated
+
+
+def is_field_due(session, sku_id, field, now):
+    # 持续监控时每轮按开始时间间隔 watch_interval, 而更新时间记录的是查询完成的时间, 留出半轮的余量,
+    # 否则间隔正好是整数轮的信息每次都要多等一轮
+    key = (sku_id, field)
+    if key not in session.field_updated:
+        return True
+    slack = session.watch_interval / 2 if session.watch_interval is not None else 0
+    return now - session.field_updated[key] + slack >= get_field_ttl(session, sku_id, field)
+
+
+def get_refresh_fields(session, sku_id):
+    # 持续监控时需要定期刷新的价格, 以及每个区域的库存和优惠券. 商品名很少变化, 不参与分配
+    fields = []
+    if 'price' in session.fetch_fields:
+        fields.append('price')
+    for field in ('stock', 'coupon'):
+        if field in session.fetch_fields:
+            fields.extend(get_area_field(session, field, area_code)
+                          for area_code in get_sku_area_codes(session, sku_id))
+    return fields
+
+
+def update_change_stats(sku_id, field, value, now):
+    # 按半衰期衰减之前的观察, 估计最近一段时间的变化频率
+    key = (sku_id, field)
+    stats = _change_stats.get(key)
+    if stats is None:
+        _change_stats[key] = [0, 0, now, value]
+        return
+    decay = 0.5 ** (max(0, now - stats[2]) / _change_half_life)
+    stats[0] = stats[0] * decay + (value != stats[3])
+    stats[1] = stats[1] * decay + (1 - decay) * _change_half_life / math.log(2)
+    stats[2] = max(stats[2], now)
+    stats[3] = value
+
+
+def load_change_stats():
+    # 用最近的历史记录估计价格, 库存和优惠券的变化频率, 历史记录中只有第一个区域的库存和优惠券
+    history_path = get_history_path()
+    if history_path is None:
+        return
+    load_history_strings(history_path)
+    start = int(time.time() - 4 * _change_half_life)
+    for sku_id in _sku_ids:
+        records = read_history(sku_id, start)
+        for idx in range(0, len(records), 4):
+            values = (format_cents(records[idx + 1]) or None, get_history_string(records[idx + 2]),
+                      get_history_string(records[idx + 3]))
+            for field, value in zip(('price', 'stock', 'coupon'), values):
+                if value is not None:
+                    update_change_stats(sku_id, field, value, records[idx])
+
+
+def observe_changes(session, since):
+    # 记录 since 之后刷新过的信息是否发生了变化, 查询失败的信息不计入
+    for sku_id in session.sku_ids:
+        errors = session.fetch_errors.get(sku_id, {})
+        for field in get_refresh_fields(session, sku_id):
+            updated = session.field_updated.get((sku_id, field), 0)
+            if updated >= since and field not in errors:
+                update_change_stats(sku_id, field, session.sku_info[sku_id][field], updated)
+
+
+def get_change_rate(sku_id, field):
+    # 每秒的变化次数, 其他区域没有观察记录时使用第一个区域的记录
+    stats = _change_stats.get((sku_id, field))
+    if stats is None:
+        stats = _change_stats.get((sku_id, field.split('@', 1)[0]))
+    if stats is None:
+        return 1 / _change_prior
+    return (stats[0] + 1) / (stats[1] + _change_prior)
+
+
+def schedule_refresh(session, sku_ids):
+    # 在平均每秒的请求数不超过预算的条件下, 使 sum(权重 * 变化频率 * 刷新间隔) 最小, 即尽快发现变化.
+    # 此时刷新间隔与 sqrt(请求数 / (权重 * 变化频率)) 成正比, 价格批量查询, 每个商品只占 1 / price_batch_size 个请求.
+    # 超出最短或最长间隔的固定为该间隔, 用剩余的预算重新分配. 返回预计每分钟的请求数
+    budget = _request_budget / 60
+    watch_interval = session.watch_interval
+    cost = 0
+    items = []
+    for sku_id in sku_ids:
+        attrs = session.sku_attr_dic.get(sku_id)
+        for field in get_refresh_fields(session, sku_id):
+            field_cost = 1 / session.price_batch_size if field == 'price' else 1
+            # 单独设置了刷新间隔的信息不参与分配, 但占用预算
+            if attrs is not None and 'refresh' in attrs:
+                cost += field_cost / max(attrs['refresh'], watch_interval)
+                continue
+            weight = _alert_weight if get_alert_rule(field.split('@', 1)[0], sku_id) else 1
+            items.append(((sku_id, field), field_cost, weight * get_change_rate(sku_id, field)))
+    intervals = {}
+    while items:
+        left = budget - cost
+        scale = sum(math.sqrt(field_cost * rate) for key, field_cost, rate in items) / left if left > 0 else None
+        free = []
+        for key, field_cost, rate in items:
+            interval = _max_refresh_interval if scale is None else math.sqrt(field_cost / rate) * scale
+            if interval <= watch_interval or interval >= _max_refresh_interval:
+                intervals[key] = min(max(interval, watch_interval), _max_refresh_interval)
+                cost += field_cost / intervals[key]
+            else:
+                free.append((key, field_cost, rate))
+        if len(free) == len(items) or not free:
+            for key, field_cost, rate in free:
+                intervals[key] = math.sqrt(field_cost / rate) * scale
+                cost += field_cost / intervals[key]
+            break
+        items = free
+    session.refresh_intervals = intervals
+    return cost * 60
+
+
+def get_info(session, type, sku_id, area_code=''):
+    field = get_area_field(session, _type_field_dic[type], area_code)
+    try:
+        if type == _TYPE_PRICE:
+            value = get_product_price(session, sku_id)
+        elif type == _TYPE_STOCK:
+            value = get_product_stock(session, sku_id, area_code or session.area_code)
+        elif type == _TYPE_COUPON:
+            value = get_product_coupon(session, sku_id, area_code or session.area_code)
+        elif type == _TYPE_NAME:
+            value = get_product_name(session, sku_id)
+        else:
+            return
+    except Exception as e:
+        record_fetch_error(session, sku_id, field, e)
+        return
+    set_sku_info(session, sku_id, field, value)
+
+
+def get_info_prices(session, sku_ids):
+    try:
+        prices = get_product_prices(session, sku_ids)
+    except Exception as e:
+        for sku_id in sku_ids:
+            record_fetch_error(session, sku_id, 'price', e)
+        return
+    for sku_id in sku_ids:
+        if sku_id in prices:
+            set_sku_info(session, sku_id, 'price', prices[sku_id])
+        else:
+            # 批量结果中缺失的 sku_id 单独再请求一次
+            get_info(session, _TYPE_PRICE, sku_id)
+
+
+def run_task_worker(task_queue, task_stat):
+    while True:
+        try:
+            func, args = task_queue.get_nowait()
+        except gevent.queue.Empty:
+            return
+        task_stat['running'] += 1
+        try:
+            func(*args)
+        except Exception as e:
+            print('任务', func.__name__, args, '失败:', repr(e), file=sys.stderr)
+        finally:
+            task_stat['running'] -= 1
+            task_stat['done'] += 1
+
+
+def print_queue_depth(task_queue, task_stat):
+    print('队列中: %d, 进行中: %d, 已完成: %d/%d' % (task_queue.qsize(), task_stat['running'],
+                                              task_stat['done'], task_stat['total']), file=sys.stderr)
+
+
+def report_queue_depth(session, task_queue, task_stat):
+    while True:
+        gevent.sleep(session.report_interval)
+        print_queue_depth(task_queue, task_stat)
+
+
+def get_run_deadline(session, since):
+    if session.run_timeout <= 0:
+        return None
+    return since + session.run_timeout
+
+
+def run_tasks(session, tasks, deadline=None):
+    task_queue = gevent.queue.Queue()
+    for task in tasks:
+        task_queue.put(task)
+    task_stat = {'total': len(tasks), 'running': 0, 'done': 0}
+    workers = []
+    for idx in range(0, min(session.max_concurrency, len(tasks))):
+        workers.append(gevent.spawn(run_task_worker, task_queue, task_stat))
+    reporter = None
+    if session.report_interval > 0:
+        reporter = gevent.spawn(report_queue_depth, session, task_queue, task_stat)
+    timeout = None
+    if deadline is not None:
+        timeout = max(0, deadline - time.time())
+    gevent.joinall(workers, timeout=timeout)
+    # 超过运行时间限制, 放弃还没有完成的任务
+    gevent.killall(workers)
+    if reporter is not None:
+        reporter.kill()
+    return task_stat
+
+
+def plan_sku_info(session):
+    # 返回需要单独查询的 [(type, sku_id, area_code)] 以及需要批量查询价格的 sku_id
+    sku_info = session.sku_info
+    plans = []
+    price_sku_ids = []
+    # 持续监控模式下只在第一轮读取缓存, 之后以内存中的更新时间为准
+    cached = {}
+    if not session.field_updated:
+        cached = load_cache(session)
+    now = time.time()
+    for sku_id in session.sku_ids:
+        if sku_id not in sku_info:
+            sku_info[sku_id] = {
+                'url': 'https://item.jd.com/' + sku_id + '.html',
+                'price': '',
+                'stock': '',
+                'coupon': '',
+                'name': ''
+            }
+            for area_code in get_all_area_codes(session)[1:]:
+                sku_info[sku_id][get_area_field(session, 'stock', area_code)] = ''
+                sku_info[sku_id][get_area_field(session, 'coupon', area_code)] = ''
+            if session.out_format == 'table':
+                set_cell_width(session, sku_id, 'url', sku_info[sku_id]['url'])
+        for type in (_TYPE_PRICE, _TYPE_STOCK, _TYPE_COUPON, _TYPE_NAME):
+            if _type_field_dic[type] not in session.fetch_fields:
+                continue
+            # 价格和商品名与区域无关, 只查询一次
+            area_codes = get_sku_area_codes(session, sku_id) if type == _TYPE_STOCK or type == _TYPE_COUPON else ['']
+            for area_code in area_codes:
+                field = get_area_field(session, _type_field_dic[type], area_code)
+                if (sku_id, field) in cached:
+                    set_sku_info(session, sku_id, field, *cached[(sku_id, field)])
+                elif not is_field_due(session, sku_id, field, now):
+                    continue
+                elif type == _TYPE_PRICE:
+                    price_sku_ids.append(sku_id)
+                else:
+                    plans.append((type, sku_id, area_code))
+    return plans, price_sku_ids
+
+
+def generate_sku_info(session):
+    op = time.time()
+    plans, price_sku_ids = plan_sku_info(session)
+    tasks = []
+    for type, sku_id, area_code in plans:
+        tasks.append((get_info, (session, type, sku_id, area_code)))
+    for sku_ids in split_list(price_sku_ids, session.price_batch_size):
+        tasks.append((get_info_prices, (session, sku_ids)))
+    run_tasks(session, tasks, get_run_deadline(session, op))
+    record_unfinished(session, plans, price_sku_ids, op)
+    save_cache(session)
+
+
+def get_async_host_limiter(session, host):
+    host_limiters = session.async_host_limiters.setdefault(asyncio.get_running_loop(), {})
+    if host not in host_limiters:
+        host_limiters[host] = new_host_limiter(session, asyncio.Semaphore(session.host_concurrency))
+    return host_limiters[host]
+
+
+async def async_acquire_host_token(session, limiter):
+    while True:
+        wait = take_host_token(session, limiter)
+        if wait <= 0:
+            return
+        await asyncio.sleep(wait)
+
+
+async def async_new_connection(scheme, url_info):
+    if scheme == 'https':
+        return await asyncio.open_connection(url_info.hostname, url_info.port or 443, ssl=ssl.create_default_context())
+    return await asyncio.open_connection(url_info.hostname, url_info.port or 80)
+
+
+async def async_read_chunked(reader):
+    body = bytearray()
+    while True:
+        size = int((await reader.readline()).split(b';')[0].strip(), 16)
+        if size == 0:
+            # 跳过 trailer
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            return bytes(body)
+        body += await reader.readexactly(size)
+        await reader.readline()
+
+
+async def async_iter_body(reader, headers):
+    # 分块读取响应的内容, 全部读完后结束
+    if (headers['Transfer-Encoding'] or '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            while size > 0:
+                chunk = await reader.readexactly(min(size, _stream_chunk_size))
+                size -= len(chunk)
+                yield chunk
+            await reader.readline()
+    elif headers['Content-Length'] is not None:
+        size = int(headers['Content-Length'])
+        while size > 0:
+            chunk = await reader.readexactly(min(size, _stream_chunk_size))
+            size -= len(chunk)
+            yield chunk
+    else:
+        while True:
+            chunk = await reader.read(_stream_chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+async def async_send_request(session, reader, writer, host, path, headers=None, method='GET', stream=False):
+    # stream 为 True 时不读取 2xx 响应的内容, 返回的内容为 None, 由调用者分块读取
+    lines = [method + ' ' + path + ' HTTP/1.1', 'Host: ' + host]
+    for key in session.headers:
+        lines.append(key + ': ' + session.headers[key])
+    for key in headers or {}:
+        lines.append(key + ': ' + headers[key])
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    status_line, _, header_bytes = head.partition(b'\r\n')
+    status = int(status_line.split()[1])
+    headers = client.parse_headers(io.BytesIO(header_bytes))
+    will_close = (headers['Connection'] or '').lower() == 'close'
+    if method == 'HEAD' or status == 304 or status == 204 or status < 200:
+        # 这些响应没有内容
+        body = b''
+    elif stream and status < 300:
+        body = None
+    elif (headers['Transfer-Encoding'] or '').lower() == 'chunked':
+        body = await async_read_chunked(reader)
+    elif headers['Content-Length'] is not None:
+        body = await reader.readexactly(int(headers['Content-Length']))
+    else:
+        body = await reader.read()
+        will_close = True
+    return status, headers, body, will_close
+
+
+def async_release_connection(session, pool, reader, writer, will_close):
+    if will_close or len(pool) >= session.host_pool_size:
+        writer.close()
+    else:
+        pool.append((reader, writer))
+
+
+async def async_open_url(session, url, request_headers=None, method='GET', follow_redirects=True, stream=False):
+    # stream 为 True 时 2xx 响应的内容为 (reader, writer, pool, will_close), 读完后用 async_release_connection 放回
+    for idx in range(0, session.max_redirects + 1):
+        url_info = parse.urlsplit(url)
+        path = url_info.path or '/'
+        if url_info.query:
+            path += '?' + url_info.query
+        pools = session.async_pools.setdefault(asyncio.get_running_loop(), {})
+        pool = pools.setdefault((url_info.scheme, url_info.netloc), [])
+        reused = len(pool) > 0
+        if reused:
+            reader, writer = pool.pop()
+        else:
+            reader, writer = await async_new_connection(url_info.scheme, url_info)
+        while True:
+            try:
+                status, headers, body, will_close = await async_send_request(session, reader, writer, url_info.netloc,
+                                                                             path, request_headers, method, stream)
+                break
+            except (OSError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+                # 复用的长连接可能已经被服务器关闭, 换一个新连接重试一次, 失败时同样关闭
+                reader, writer = await async_new_connection(url_info.scheme, url_info)
+                reused = False
+            except BaseException:
+                writer.close()
+                raise
+        if body is None:
+            return status, headers, (reader, writer, pool, will_close)
+        async_release_connection(session, pool, reader, writer, will_close)
+        if follow_redirects and status in (301, 302, 303, 307, 308) and headers['Location'] is not None:
+            url = parse.urljoin(url, headers['Location'])
+            continue
+        if status >= 400:
+            raise error.HTTPError(url, status, client.responses.get(status, ''), headers, None)
+        return status, headers, body
+    raise error.URLError('重定向次数过多: ' + url)
+
+
+async def async_request_html_content(session, url, timeout, endpoint=None, entry=None, raw=False):
+    limiter = get_async_host_limiter(session, get_url_host(url))
+    async with limiter['semaphore']:
+        await async_acquire_host_token(session, limiter)
+        op = time.perf_counter()
+        try:
+            status, headers, data = await asyncio.wait_for(
+                async_open_url(session, url, get_conditional_headers(entry)), timeout)
+        except Exception as e:
+            record_request(session, endpoint, time.perf_counter() - op, e)
+            raise
+        record_request(session, endpoint, time.perf_counter() - op)
+    data = decompress_content(session, data, headers, endpoint)
+    if check_not_modified(session, entry, status, headers, data, endpoint):
+        return _not_modified
+    if raw:
+        return data, get_html_encoding(headers)
+    return decode_html_content(session, data, headers, endpoint, True)
+
+
+async def async_request_head(session, url, timeout, endpoint=None):
+    # 不跟随重定向, 只返回状态和响应头
+    limiter = get_async_host_limiter(session, get_url_host(url))
+    async with limiter['semaphore']:
+        await async_acquire_host_token(session, limiter)
+        op = time.perf_counter()
+        try:
+            status, headers, body = await asyncio.wait_for(async_open_url(session, url, None, 'HEAD', False), timeout)
+        except Exception as e:
+            record_request(session, endpoint, time.perf_counter() - op, e)
+            raise
+        record_request(session, endpoint, time.perf_counter() - op)
+    return status, headers
+
+
+async def async_read_product_name(session, url, entry):
+    status, headers, body = await async_open_url(session, url, get_conditional_headers(entry), stream=True)
+    # 与 get_product_name_stream 相同, 只读取页面的一部分, 只使用服务器返回的 304
+    if status == 304:
+        check_not_modified(session, entry, 304, headers, None, 'name')
+        return _not_modified
+    check_not_modified(session, entry, status, headers, None, 'name')
+    reader, writer, pool, will_close = body
+    stream = new_name_stream(headers)
+    name = None
+    chunks = async_iter_body(reader, headers)
+    finished = False
+    try:
+        async for chunk in chunks:
+            name = feed_name_stream(stream, chunk)
+            if name is not None:
+                break
+        else:
+            finished = True
+    finally:
+        await chunks.aclose()
+        # 没有读完的连接无法复用
+        if finished:
+            async_release_connection(session, pool, reader, writer, will_close)
+        else:
+            writer.close()
+    return stream, name, get_html_encoding(headers)
+
+
+async def async_get_product_name_stream(session, url, timeout, entry=None):
+    limiter = get_async_host_limiter(session, get_url_host(url))
+    async with limiter['semaphore']:
+        await async_acquire_host_token(session, limiter)
+        op = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(async_read_product_name(session, url, entry), timeout)
+        except Exception as e:
+            record_request(session, 'name', time.perf_counter() - op, e)
+            raise
+        record_request(session, 'name', time.perf_counter() - op)
+    if result is _not_modified:
+        return result
+    return finish_name_stream(session, *result)
+
+
+async def async_call_with_retry(session, url, func, *args):
+    host = get_url_host(url)
+    for attempt in range(0, session.max_retries + 1):
+        check_circuit(session, host)
+        try:
+            result = await func(session, *args)
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            record_host_result(session, host, False)
+            if attempt >= session.max_retries:
+                raise
+            await asyncio.sleep(get_retry_delay(session, attempt))
+            continue
+        record_host_result(session, host, True)
+        return result
+
+
+async def async_get_html_content(session, url, endpoint=None, entry=None, raw=False):
+    return await async_call_with_retry(session, url, async_request_html_content, url, get_timeout(session, endpoint),
+                                       endpoint, entry, raw)
+
+
+async def async_get_product_name(session, sku_id):
+    url = get_name_url(session, sku_id)
+    entry = get_http_cache_entry(session, url, get_product_name_stream.__name__)
+    try:
+        name = await async_call_with_retry(session, url, async_get_product_name_stream, url,
+                                           get_timeout(session, 'name'), entry)
+    except (zlib.error, UnicodeDecodeError):
+        return await async_get_parsed_content(session, url, 'name', parse_product_name)
+    return set_http_cache_entry(session, url, get_product_name_stream.__name__, entry, name)
+
+
+async def async_get_parsed_content(session, url, endpoint, func, raw=False):
+    entry = get_http_cache_entry(session, url, func.__name__)
+    contents = await async_get_html_content(session, url, endpoint, entry, raw)
+    if contents is _not_modified:
+        pass
+    elif raw:
+        contents = parse_content(session, endpoint, func, *contents)
+    else:
+        contents = parse_content(session, endpoint, func, contents)
+    return set_http_cache_entry(session, url, func.__name__, entry, contents)
+
+
+async def async_get_info(session, type, sku_id, area_code=''):
+    field = get_area_field(session, _type_field_dic[type], area_code)
+    try:
+        if type == _TYPE_PRICE:
+            url = get_price_url(session, [sku_id])
+            value = await async_get_parsed_content(session, url, 'price', parse_product_price, True)
+        elif type == _TYPE_STOCK:
+            url = get_stock_url(session, sku_id, area_code or session.area_code)
+            value = await async_get_parsed_content(session, url, 'stock', parse_product_stock, True)
+        elif type == _TYPE_COUPON:
+            url = get_coupon_url(session, sku_id, area_code or session.area_code)
+            value = await async_get_parsed_content(session, url, 'coupon', parse_product_coupon, True)
+        elif type == _TYPE_NAME:
+            value = await async_get_product_name(session, sku_id)
+        else:
+            return
+    except Exception as e:
+        record_fetch_error(session, sku_id, field, e)
+        return
+    set_sku_info(session, sku_id, field, value)
+
+
+async def async_get_info_prices(session, sku_ids):
+    try:
+        url = get_price_url(session, sku_ids)
+        prices = await async_get_parsed_content(session, url, 'price', parse_product_prices, True)
+    except Exception as e:
+        for sku_id in sku_ids:
+            record_fetch_error(session, sku_id, 'price', e)
+        return
+    for sku_id in sku_ids:
+        if sku_id in prices:
+            set_sku_info(session, sku_id, 'price', prices[sku_id])
+        else:
+            await async_get_info(session, _TYPE_PRICE, sku_id)
+
+
+async def async_probe_sku_prices(session, sku_ids, result):
+    # 能查到价格的商品一定有效, 查询失败或者价格为 -1 的留给商品页面判断
+    try:
+        contents = await async_get_html_content(session, get_price_url(session, sku_ids), 'price', None, True)
+        prices = parse_product_prices(*contents)
+    except Exception:
+        return
+    for sku_id in sku_ids:
+        if get_price_value(prices.get(sku_id, '')) is not None:
+            result[sku_id] = True
+
+
+async def async_probe_sku_page(session, sku_id, result):
+    url = get_name_url(session, sku_id)
+    try:
+        status, headers = await async_request_head(session, url, get_timeout(session, 'name'), 'check')
+    except error.HTTPError as e:
+        if e.code == 404:
+            result[sku_id] = False
+        return
+    except Exception:
+        return
+    if status in (301, 302, 303, 307, 308):
+        # 可能只是跳转到同一个商品的其他地址
+        location = parse.urljoin(url, headers['Location'] or '')
+        result[sku_id] = parse.urlsplit(location).path.endswith('/' + sku_id + '.html')
+    else:
+        result[sku_id] = True
+
+
+async def async_run_task_worker(task_queue, task_stat):
+    while not task_queue.empty():
+        func, args = task_queue.get_nowait()
+        task_stat['running'] += 1
+        try:
+            await func(*args)
+        except Exception as e:
+            print('任务', func.__name__, args, '失败:', repr(e), file=sys.stderr)
+        finally:
+            task_stat['running'] -= 1
+            task_stat['done'] += 1
+
+
+async def async_report_queue_depth(session, task_queue, task_stat):
+    while True:
+        await asyncio.sleep(session.report_interval)
+        print_queue_depth(task_queue, task_stat)
+
+
+async def async_run_tasks(session, tasks, deadline=None):
+    task_queue = asyncio.Queue()
+    for task in tasks:
+        task_queue.put_nowait(task)
+    task_stat = {'total': len(tasks), 'running': 0, 'done': 0}
+    workers = []
+    for idx in range(0, min(session.max_concurrency, len(tasks))):
+        workers.append(asyncio.ensure_future(async_run_task_worker(task_queue, task_stat)))
+    reporter = None
+    if session.report_interval > 0:
+        reporter = asyncio.ensure_future(async_report_queue_depth(session, task_queue, task_stat))
+    if workers:
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, deadline - time.time())
+        done, pending = await asyncio.wait(workers, timeout=timeout)
+        # 超过运行时间限制, 放弃还没有完成的任务
+        for worker in pending:
+            worker.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    if reporter is not None:
+        reporter.cancel()
+    return task_stat
+
+
+def async_close_pools(session):
+    # 只关闭当前事件循环中空闲的连接, 同时进行的其他请求结束后会重新放入连接池
+    pools = session.async_pools.pop(asyncio.get_running_loop(), {})
+    for key in pools:
+        for reader, writer in pools[key]:
+            writer.close()
+
+
+async def async_probe_sku_ids(session, sku_ids, result):
+    try:
+        await async_run_tasks(session, [(async_probe_sku_prices, (session, batch, result))
+                                        for batch in split_list(sku_ids, session.price_batch_size)])
+        await async_run_tasks(session, [(async_probe_sku_page, (session, sku_id, result)) for sku_id in sku_ids
+                                        if result[sku_id] is None])
+    finally:
+        async_close_pools(session)
+
+
+async def async_fetch_area_children(session, area_id):
+    contents = await async_get_html_content(session, get_area_url(session, area_id), 'area')
+    store_area_children(session, area_id, contents, False)
+
+
+async def async_fetch_areas(session, area_ids):
+    try:
+        await async_run_tasks(session, [(async_fetch_area_children, (session, area_id)) for area_id in area_ids])
+    finally:
+        async_close_pools(session)
+
+
+async def async_generate_sku_info(session):
+    op = time.time()
+    plans, price_sku_ids = plan_sku_info(session)
+    tasks = []
+    for type, sku_id, area_code in plans:
+        tasks.append((async_get_info, (session, type, sku_id, area_code)))
+    for sku_ids in split_list(price_sku_ids, session.price_batch_size):
+        tasks.append((async_get_info_prices, (session, sku_ids)))
+    try:
+        await async_run_tasks(session, tasks, get_run_deadline(session, op))
+    finally:
+        async_close_pools(session)
+    record_unfinished(session, plans, price_sku_ids, op)
+    save_cache(session)
+
+
+def run_coroutine(coroutine):
+    # 没有正在运行的事件循环时直接运行. 在事件循环中调用同步的接口时(比如在 async 函数中调用 JDClient.fetch)
+    # 不能再用 asyncio.run, 改为在另一个线程中用新的事件循环运行, 完成前会阻塞当前的事件循环
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with futures.ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def get_worker_config(session, workers):
+    config = {}
+    for name in _session_config_names:
+        config[name] = getattr(session, name)
+    # 并发数和请求速率平分给每个子进程, 总数不变
+    config['max_concurrency'] = max(1, session.max_concurrency // workers)
+    config['host_concurrency'] = max(1, session.host_concurrency // workers)
+    config['host_pool_size'] = max(1, session.host_pool_size // workers)
+    if session.host_rate > 0:
+        config['host_rate'] = max(1, session.host_rate // workers)
+    config['workers'] = 1
+    config['report_interval'] = 0
+    return config
+
+
+def run_worker(config, sku_ids, sku_info, field_updated, fetch_errors):
+    # 在子进程中运行, 查询一部分商品并返回结果
+    if config['engine'] == 'gevent':
+        gevent.monkey.patch_all()
+    session = FetchSession(**config)
+    session.sku_ids = dict.fromkeys(sku_ids, True)
+    session.sku_info.update(sku_info)
+    session.field_updated.update(field_updated)
+    session.fetch_errors.update(fetch_errors)
+    fetch_sku_info(session)
+    session.close()
+    return (session.sku_info, session.cell_width_dic, session.max_width_dic, session.field_updated,
+            session.fetch_errors, session.profile_dic)
+
+
+def fetch_sku_info_in_workers(session):
+    sku_ids = list(session.sku_ids)
+    workers = min(session.workers, len(sku_ids))
+    shards = split_list(sku_ids, (len(sku_ids) + workers - 1) // workers)
+    shard_idx_dic = {}
+    args = []
+    config = get_worker_config(session, workers)
+    for idx, shard in enumerate(shards):
+        for sku_id in shard:
+            shard_idx_dic[sku_id] = idx
+        args.append((config, shard, {}, {}, {}))
+    # 持续监控模式下把上一轮的结果一起传给子进程, 以便只查询到期的字段
+    for sku_id in session.sku_info:
+        if sku_id in shard_idx_dic:
+            args[shard_idx_dic[sku_id]][2][sku_id] = session.sku_info[sku_id]
+    for key in session.field_updated:
+        if key[0] in shard_idx_dic:
+            args[shard_idx_dic[key[0]]][3][key] = session.field_updated[key]
+    for sku_id in session.fetch_errors:
+        if sku_id in shard_idx_dic:
+            args[shard_idx_dic[sku_id]][4][sku_id] = session.fetch_errors[sku_id]
+    # 使用 spawn, 子进程不会继承 gevent 的 monkey patch 以及连接池等状态
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        results = pool.starmap(run_worker, args)
+    for sku_id in sku_ids:
+        session.fetch_errors.pop(sku_id, None)
+    for sku_info, cell_width_dic, max_width_dic, field_updated, fetch_errors, profile_dic in results:
+        session.sku_info.update(sku_info)
+        session.cell_width_dic.update(cell_width_dic)
+        for field in max_width_dic:
+            session.max_width_dic[field] = max(session.max_width_dic.get(field, 0), max_width_dic[field])
+        session.field_updated.update(field_updated)
+        session.fetch_errors.update(fetch_errors)
+        merge_profile(session, profile_dic)
+
+
+def fetch_sku_info(session):
+    if session.workers > 1 and len(session.sku_ids) > 1:
+        fetch_sku_info_in_workers(session)
+    elif session.engine == 'asyncio':
+        run_coroutine(async_generate_sku_info(session))
+    else:
+        generate_sku_info(session)
+
+
+class SkuRecord(object):
+    # stocks 和 coupons 与查询时的 area_codes 一一对应, 没有查询的信息为 None
+    __slots__ = ('sku_id', 'price', 'name', 'stocks', 'coupons', 'errors')
+
+    def __init__(self, sku_id, price=None, name=None, stocks=None, coupons=None, errors=None):
+        self.sku_id = sku_id
+        self.price = price
+        self.name = name
+        self.stocks = stocks
+        self.coupons = coupons
+        self.errors = errors
+
+    @property
+    def url(self):
+        return 'https://item.jd.com/' + self.sku_id + '.html'
+
+    @property
+    def stock(self):
+        return None if self.stocks is None else self.stocks[0]
+
+    @property
+    def coupon(self):
+        return None if self.coupons is None else self.coupons[0]
+
+    def __repr__(self):
+        return 'SkuRecord(%r, price=%r, stocks=%r, coupons=%r, name=%r, errors=%r)' % (
+            self.sku_id, self.price, self.stocks, self.coupons, self.name, self.errors)
+
+
+def get_sku_record(session, sku_id, fields, area_codes):
+    sku_info = session.sku_info.get(sku_id, {})
+    record = SkuRecord(sku_id)
+    if 'price' in fields:
+        record.price = sku_info.get('price', '')
+    if 'name' in fields:
+        record.name = sku_info.get('name', '')
+    if 'stock' in fields:
+        record.stocks = tuple(sku_info.get(get_area_field(session, 'stock', area_code), '')
+                              for area_code in area_codes)
+    if 'coupon' in fields:
+        record.coupons = tuple(sku_info.get(get_area_field(session, 'coupon', area_code), '')
+                               for area_code in area_codes)
+    if sku_id in session.fetch_errors:
+        record.errors = dict(session.fetch_errors[sku_id])
+    return record
+
+
+class JDClient(object):
+    # 在 self.session 中保存一组独立的配置, 查询结果, 缓存和连接, 多次查询之间复用. 配置的名称与 FetchSession 相同,
+    # 如 JDClient(in_path=None, area_codes=['1_72_2799_0']). 没有 monkey patch 时 gevent 不能并发, 默认使用 asyncio.
+    # 不同的 JDClient 互不影响, 可以在不同的线程或事件循环中同时查询, 同一个 JDClient 的查询依次执行
+    def __init__(self, **config):
+        config.setdefault('engine', 'asyncio')
+        # 只返回记录而不输出表格时不需要记录列宽, 命令行会传入 out_format
+        config.setdefault('out_format', None)
+        self.session = FetchSession(**config)
+        # 在创建时生成, 所以 gevent 需要在创建 JDClient 之前 monkey patch
+        self.lock = threading.RLock()
+        # afetch 在同一个事件循环中依次执行 {事件循环: asyncio.Lock}
+        self.async_locks = weakref.WeakKeyDictionary()
+
+    def get_async_lock(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.async_locks:
+            self.async_locks[loop] = asyncio.Lock()
+        return self.async_locks[loop]
+
+    @contextlib.contextmanager
+    def query(self, sku_ids, fields, area_codes):
+        # 临时设置这次查询的商品, 信息和区域. 不在这次查询中的商品的结果不再保留, 以免越积越多,
+        # 之后再查询这些商品时仍然可以使用文件中的缓存
+        session = self.session
+        fetch_fields = session.fetch_fields
+        all_area_codes = session.area_codes
+        session.sku_ids = dict.fromkeys(sku_ids, True)
+        for sku_id in [sku_id for sku_id in session.sku_info if sku_id not in session.sku_ids]:
+            del session.sku_info[sku_id]
+            session.fetch_errors.pop(sku_id, None)
+        for key in [key for key in session.field_updated if key[0] not in session.sku_ids]:
+            del session.field_updated[key]
+        if fields is not None:
+            session.fetch_fields = list(fields)
+        if area_codes is not None:
+            session.area_codes = list(area_codes)
+        try:
+            yield session
+        finally:
+            session.fetch_fields = fetch_fields
+            session.area_codes = all_area_codes
+
+    def fetch(self, sku_ids, fields=None, area_codes=None):
+        # 返回与 sku_ids 顺序相同的 SkuRecord 列表, 没有过期的信息直接使用上次的结果.
+        # 也可以在事件循环中调用, 但查询完成前会阻塞该事件循环, 这时应该使用 afetch
+        sku_ids = [str(sku_id) for sku_id in sku_ids]
+        with self.lock, self.query(sku_ids, fields, area_codes) as session:
+            fetch_sku_info(session)
+            return [get_sku_record(session, sku_id, session.fetch_fields, get_all_area_codes(session))
+                    for sku_id in sku_ids]
+
+    async def afetch(self, sku_ids, fields=None, area_codes=None):
+        # 在事件循环中代替 fetch, 总是使用 asyncio 查询. 同一个事件循环中同一个 JDClient 的多个 afetch 依次执行
+        sku_ids = [str(sku_id) for sku_id in sku_ids]
+        async with self.get_async_lock():
+            with self.query(sku_ids, fields, area_codes) as session:
+                await async_generate_sku_info(session)
+                return [get_sku_record(session, sku_id, session.fetch_fields, get_all_area_codes(session))
+                        for sku_id in sku_ids]
+
+    def check(self, sku_ids):
+        # 返回 {sku_id: 是否有效}
+        with self.lock:
+            return check_sku_ids(self.session, [str(sku_id) for sku_id in sku_ids])
+
+    async def acheck(self, sku_ids):
+        # 在事件循环中代替 check, 与 afetch 一样在同一个事件循环中依次执行
+        async with self.get_async_lock():
+            return await async_check_sku_ids(self.session, [str(sku_id) for sku_id in sku_ids])
+
+    def get_profile_report(self, wall_time=0):
+        with self.lock:
+            return get_profile_report(self.session, wall_time)
+
+    def close(self):
+        with self.lock:
+            self.session.close()
 
 
 def inc(value):
@@ -604,8 +3606,10 @@ def fixed(value):
     return value
 
 
-def get_column(content_list, align_type_list, fill_char=' ', star_str='| ', interval_str=' | ', end_str=' |'):
-    global _show_rows, _max_width_dic
+def get_column(session, content_list, align_type_list, fill_char=' ', star_str='| ', interval_str=' | ',
+               end_str=' |'):
+    global _show_rows
+    max_width_dic = session.max_width_dic
     align_type_idx_func = inc
     content_idx_func = inc
     align_type_idx = 0
@@ -614,59 +3618,236 @@ def get_column(content_list, align_type_list, fill_char=' ', star_str='| ', inte
         content_idx_func = fixed
     if len(align_type_list) == 1:
         align_type_idx_func = fixed
-    line = star_str + align_string(content_list[content_idx], _max_width_dic[_show_rows[0]],
+    line = star_str + align_string(content_list[content_idx], max_width_dic[_show_rows[0]],
                                    align_type_list[align_type_idx], fill_char)
     for idx in range(1, len(_show_rows)):
         content_idx = content_idx_func(content_idx)
         align_type_idx = align_type_idx_func(align_type_idx)
-        line += interval_str + align_string(content_list[content_idx], _max_width_dic[_show_rows[idx]],
+        line += interval_str + align_string(content_list[content_idx], max_width_dic[_show_rows[idx]],
                                             align_type_list[align_type_idx], fill_char)
     line += end_str
     return line
 
 
-def show_sku_info():
-    global _sku_ids, _sku_info, _show_rows, _align_type_dic, _tight
-    if not _sku_ids:
-        return
-    contents = [get_column([''], [0], '-', '+-', '-+-', '-+'),
-                get_column(_show_rows, [0]),
-                get_column([''], [0], '-', '+-', '-+-', '-+')]
-    align_type_list = []
-    for row_name in _show_rows:
-        align_type_list.append(_align_type_dic[row_name])
-    for sku_id in _sku_info:
-        sku_info = []
-        for row_name in _show_rows:
-            sku_info.append(_sku_info[sku_id][row_name])
-        contents.append(get_column(sku_info, align_type_list, ' ', '| ', ' | ', ' |'))
+def get_sku_line(session, sku_id, align_type_list, star_str='| ', interval_str=' | ', end_str=' |'):
+    # 使用 cell_width_dic 中缓存的宽度, 不再重新计算每个单元格的显示宽度
+    sku_info = session.sku_info[sku_id]
+    cells = []
+    for idx, row_name in enumerate(_show_rows):
+        value = sku_info[row_name]
+        cells.append(align_string(value, session.max_width_dic[row_name], align_type_list[idx], ' ',
+                                  session.cell_width_dic.get((sku_id, row_name))))
+    return star_str + interval_str.join(cells) + end_str
+
+
+def get_sku_info_lines(session, sku_ids):
+    # 逐行生成表格, 不在内存中保存整个表格
+    separator = get_column(session, [''], [0], '-', '+-', '-+-', '-+')
+    yield separator
+    yield get_column(session, [_row_title_dic.get(row_name, row_name) for row_name in _show_rows], [0])
+    yield separator
+    align_type_list = [_align_type_dic[row_name] for row_name in _show_rows]
+    for sku_id in sku_ids:
+        yield get_sku_line(session, sku_id, align_type_list)
         if not _tight:
-            contents.append(get_column([''], [0], '-', '+-', '-+-', '-+'))
+            yield separator
     if _tight:
-        contents.append(get_column([''], [0], '-', '+-', '-+-', '-+'))
+        yield separator
+
+
+def write_jsonl_records(session, fp, sku_ids, header):
+    for sku_id in sku_ids:
+        record = {'sku_id': sku_id}
+        sku_info = session.sku_info[sku_id]
+        for row_name in _show_rows:
+            record[row_name] = sku_info[row_name]
+        fp.write(simplejson.dumps(record, ensure_ascii=False) + '\n')
+
+
+def write_csv_records(session, fp, sku_ids, header):
+    writer = csv.writer(fp)
+    if header:
+        writer.writerow(['sku_id'] + _show_rows)
+    for sku_id in sku_ids:
+        sku_info = session.sku_info[sku_id]
+        writer.writerow([sku_id] + [sku_info[row_name] for row_name in _show_rows])
+
+
+def pack_binary_string(string):
+    data = string.encode('utf-8')
+    return _binary_length.pack(len(data)) + data
+
+
+def write_binary_records(session, fp, sku_ids, header):
+    if header:
+        fp.write(_binary_magic + _binary_count.pack(len(_show_rows)))
+        for row_name in _show_rows:
+            data = row_name.encode('utf-8')
+            fp.write(_binary_count.pack(len(data)) + data)
+    for sku_id in sku_ids:
+        sku_info = session.sku_info[sku_id]
+        fp.write(pack_binary_string(sku_id) + b''.join(pack_binary_string(sku_info[row_name])
+                                                       for row_name in _show_rows))
+
+
+def read_binary_records(fp):
+    # 读取 write_binary_records 写出的文件, 逐条返回 {'sku_id': ..., 字段: 值}
+    if fp.read(len(_binary_magic)) != _binary_magic:
+        raise ValueError('不是有效的二进制输出文件')
+    field_count = _binary_count.unpack(fp.read(_binary_count.size))[0]
+    fields = []
+    for idx in range(0, field_count):
+        length = _binary_count.unpack(fp.read(_binary_count.size))[0]
+        fields.append(fp.read(length).decode('utf-8'))
+    fields.insert(0, 'sku_id')
+    while True:
+        record = {}
+        for field in fields:
+            data = fp.read(_binary_length.size)
+            if not data:
+                return
+            length = _binary_length.unpack(data)[0]
+            record[field] = fp.read(length).decode('utf-8')
+        yield record
+
+
+_format_writer_dic = {
+    'jsonl': write_jsonl_records,
+    'csv': write_csv_records,
+    'binary': write_binary_records
+}
+
+
+def write_sku_records(session, sku_ids, append):
+    global _stdout_header_written
+    writer = _format_writer_dic[_out_format]
+    if _out_path is None:
+        fp = sys.stdout.buffer if _out_format == 'binary' else sys.stdout
+        writer(session, fp, sku_ids, not _stdout_header_written)
+        _stdout_header_written = True
+        fp.flush()
+        return
+    mode = 'a' if append else 'w'
+    if _out_format == 'binary':
+        fp = open(_out_path, mode + 'b')
+    else:
+        fp = codecs.open(_out_path, mode, 'utf-8')
+    with fp:
+        # 追加到已有文件时不再重复写表头
+        writer(session, fp, sku_ids, fp.tell() == 0)
+
+
+def show_sku_info(session, sku_ids=None, title=None):
     global _out_path
+    if not session.sku_ids:
+        return
+    if sku_ids is None:
+        sku_ids = session.sku_info
+    if _out_format != 'table':
+        # 持续监控模式下追加到输出文件末尾, 不输出标题
+        write_sku_records(session, sku_ids, title is not None)
+        return
+    lines = get_sku_info_lines(session, sku_ids)
     if _out_path is None:
-        for line in contents:
+        if title is not None:
+            print(title)
+        for line in lines:
             print(line)
     else:
-        with codecs.open(_out_path, 'w', 'utf-8') as fp:
-            for line in contents:
+        # 持续监控模式下追加到输出文件末尾
+        with codecs.open(_out_path, 'w' if title is None else 'a', 'utf-8') as fp:
+            if title is not None:
+                fp.write(title + os.linesep)
+            for line in lines:
                 fp.write(line + os.linesep)
 
 
+def get_watch_values(session):
+    global _watch_fields
+    values = {}
+    for sku_id in session.sku_info:
+        values[sku_id] = tuple(session.sku_info[sku_id][field] for field in _watch_fields)
+    return values
+
+
+def watch_sku_info(jd_client):
+    global _watch_interval
+    session = jd_client.session
+    previous = None
+    started = time.time()
+    alert_previous = {}
+    if has_alert_rules():
+        alert_previous = get_last_history_values(_sku_ids)
+    if _request_budget is not None:
+        load_change_stats()
+    try:
+        while True:
+            op = time.time()
+            if _request_budget is not None:
+                expected = schedule_refresh(session, _sku_ids)
+                if previous is None and round(expected, 1) > _request_budget:
+                    print('请求预算不足: 所有信息都按最长间隔 %d 秒刷新时, 平均每分钟仍需 %.1f 个请求.' % (
+                        _max_refresh_interval, expected), file=sys.stderr)
+            jd_client.fetch(_sku_ids)
+            print_fetch_errors(session)
+            store_history(session, op)
+            if _request_budget is not None:
+                observe_changes(session, op)
+            current = get_watch_values(session)
+            check_alerts(session, alert_previous)
+            # 提醒只比较第一个区域的 (价格, 库存, 优惠券), 其他区域的库存和优惠券排在 _watch_fields 的后面
+            alert_previous = dict((sku_id, current[sku_id][:3]) for sku_id in current)
+            if previous is None:
+                changed = list(current)
+            else:
+                changed = [sku_id for sku_id in current if current[sku_id] != previous.get(sku_id)]
+            previous = current
+            if changed:
+                title = time.strftime('%Y-%m-%d %H:%M:%S') + ' 变化的商品数: ' + str(len(changed))
+                show_sku_info(session, changed, title)
+            time.sleep(max(0, _watch_interval - (time.time() - op)))
+    except KeyboardInterrupt:
+        jd_client.close()
+        if _profile:
+            print_profile(session, time.time() - started)
+        print('已退出持续监控.', file=sys.stderr)
+
+
 def open_out_file():
     global _out_path
-    if _out_path is None:
+    # 只在 Windows 上用关联的程序打开输出文件
+    if _out_path is None or _out_format == 'binary' or sys.platform != 'win32':
         return
-    os.system('start {}'.format(os.path.abspath(_out_path)))
+    os.startfile(os.path.abspath(_out_path))
 
 
 if __name__ == '__main__':
-    handle_argv()
+    argument_result = handle_argv()
+    if is_manage_only(sys.argv[1:]):
+        sys.exit(0 if argument_result else 1)
     get_info_in_file()
-    gevent.monkey.patch_all()
+    _fetch_fields = get_fetch_fields()
+    # 多进程模式下由子进程各自 patch
+    if _engine == 'gevent' and _workers <= 1:
+        gevent.monkey.patch_all()
+    # 命令行也通过 JDClient 查询, 配置来自上面处理过的全局变量. 不能命名为 client, 否则会覆盖 http.client
+    jd_client = JDClient(engine=_engine, out_format=_out_format)
+    session = jd_client.session
+    init_area_fields(session)
+    if _watch_interval is not None:
+        watch_sku_info(jd_client)
+        sys.exit(0)
+    alert_previous = {}
+    if has_alert_rules():
+        alert_previous = get_last_history_values(_sku_ids)
     op = time.time()
-    generate_sku_info()
-    print('time: %s' % (time.time() - op))
-    show_sku_info()
+    jd_client.fetch(_sku_ids)
+    print('time: %s' % (time.time() - op), file=sys.stderr)
+    print_fetch_errors(session)
+    if _profile:
+        print_profile(session, time.time() - op)
+    check_alerts(session, alert_previous)
+    store_history(session, op)
+    show_sku_info(session)
     open_out_file()
+    jd_client.close()
@@ -0,0 +1,455 @@
+import bisect
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from urllib import request
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 在本地模拟服务器上比较 gevent 和 asyncio 两种并发方式的查询速度.
+# 用法: python benchmark.py [-sizes=100,1000,10000,50000] [-engines=gevent,asyncio] [-latency=20] [-jitter=0]
+#       [-error_rate=0] [-drop_rate=0] [-replay=recordings.json] [-concurrency=64] [-workers=1,4]
+# 测试输出表格的速度: python benchmark.py -render=100000
+# 测试批量检查商品 id 的速度: python benchmark.py -check=5000 [-latency=20]
+# 测试不查询商品信息的命令的启动时间: python benchmark.py -startup=10
+# 测试解析价格, 库存和优惠券的速度: python benchmark.py -parse=2000 [-replay=recordings.json]
+# 模拟持续监控时按请求预算分配刷新间隔的效果: python benchmark.py -schedule=300 [-budget=30]
+
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+# 不查询商品信息时不应该加载的模块
+_network_modules = ('gevent', 'asyncio', 'ssl', 'http.client', 'urllib.request', 'simplejson')
+_options = {
+    'sizes': '100,1000,10000,50000',
+    'engines': 'gevent,asyncio',
+    'latency': '20',
+    'jitter': '0',
+    'error_rate': '0',
+    'drop_rate': '0',
+    'replay': None,
+    'concurrency': '64',
+    'workers': '1'
+}
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def get_server_stat(port):
+    with request.urlopen('http://127.0.0.1:%d/__stat' % port) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+
+def start_mock_server(port, options):
+    args = [sys.executable, os.path.join(_base_dir, 'mock_server.py'), '-port=%d' % port]
+    for key in ('latency', 'jitter', 'error_rate', 'drop_rate', 'replay'):
+        if options[key] is not None:
+            args.append('-%s=%s' % (key, options[key]))
+    process = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+    for idx in range(0, 100):
+        try:
+            get_server_stat(port)
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('模拟服务器启动失败')
+
+
+def run_child(engine, sku_count, port, concurrency, workers):
+    # 每次在新的进程中运行, 避免 gevent 的 monkey patch 影响 asyncio
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '-child', '-engine=' + engine,
+                                      '-sku_count=%d' % sku_count, '-port=%d' % port,
+                                      '-concurrency=%d' % concurrency, '-workers=%d' % workers])
+    return json.loads(output.decode('utf-8').strip().split('\n')[-1])
+
+
+def get_peak_memory():
+    # 返回进程(以及子进程中最大的)占用内存的峰值, 单位为 MB, 不支持时返回 0
+    if resource is None:
+        return 0
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # macOS 上的单位为字节, 其它系统为 KB
+    if sys.platform == 'darwin':
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def child_main(engine, sku_count, port, concurrency, workers):
+    # 多进程模式下由 JDUtil 的子进程各自 patch
+    if engine == 'gevent' and workers <= 1:
+        import gevent.monkey
+        gevent.monkey.patch_all()
+    sys.path.insert(0, _base_dir)
+    import JDUtil
+    base_url = 'http://127.0.0.1:%d' % port
+    for endpoint in JDUtil._endpoint_dic:
+        JDUtil._endpoint_dic[endpoint] = base_url
+    JDUtil._in_path = None
+    JDUtil._engine = engine
+    JDUtil._max_concurrency = concurrency
+    JDUtil._workers = workers
+    # 所有接口都指向同一个地址, 不再按域名限制
+    JDUtil._host_concurrency = concurrency
+    JDUtil._host_pool_size = concurrency
+    JDUtil._host_rate = 0
+    session = JDUtil.FetchSession()
+    for idx in range(0, sku_count):
+        session.sku_ids[str(100000 + idx)] = True
+    op = time.time()
+    JDUtil.fetch_sku_info(session)
+    wall_time = time.time() - op
+    missing = 0
+    for sku_id in session.sku_info:
+        if session.sku_info[sku_id]['name'] == '' or session.sku_info[sku_id]['price'] == '':
+            missing += 1
+    print(json.dumps({'wall_time': wall_time, 'missing': missing, 'peak_memory': get_peak_memory()}))
+
+
+def render_main(row_count):
+    sys.path.insert(0, _base_dir)
+    import JDUtil
+    session = JDUtil.FetchSession(in_path=None)
+    op = time.time()
+    for idx in range(0, row_count):
+        sku_id = str(100000 + idx)
+        session.sku_ids[sku_id] = True
+        session.sku_info[sku_id] = {}
+        JDUtil.set_sku_info(session, sku_id, 'url', 'https://item.jd.com/' + sku_id + '.html', 0)
+        JDUtil.set_sku_info(session, sku_id, 'price', '%d.%02d' % (idx % 5000 + 1, idx % 100), 0)
+        JDUtil.set_sku_info(session, sku_id, 'stock', '有货' if idx % 3 else '无货', 0)
+        JDUtil.set_sku_info(session, sku_id, 'coupon', '满%d减%d' % (idx % 7 * 100, idx % 7 * 10) if idx % 7 else '',
+                            0)
+        JDUtil.set_sku_info(session, sku_id, 'name', '模拟商品 ' + sku_id * (idx % 4 + 1), 0)
+    fill_time = time.time() - op
+    fd, out_path = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    JDUtil._out_path = out_path
+    try:
+        tracemalloc.start()
+        op = time.time()
+        JDUtil.show_sku_info(session)
+        render_time = time.time() - op
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        size = os.path.getsize(out_path)
+    finally:
+        os.remove(out_path)
+    print('%8s %10s %10s %12s %12s' % ('rows', 'fill(s)', 'render(s)', 'rows/s', 'peak(KB)'))
+    print('%8d %10.2f %10.2f %12.1f %12.1f' % (row_count, fill_time, render_time, row_count / render_time,
+                                               peak / 1024))
+    print('输出文件大小:', size, '字节')
+
+
+def check_main(sku_count, options):
+    # 每 10 个商品中有一个是不存在的商品, 需要额外请求商品页面
+    port = get_free_port()
+    server = start_mock_server(port, options)
+    try:
+        sys.path.insert(0, _base_dir)
+        import JDUtil
+        base_url = 'http://127.0.0.1:%d' % port
+        for endpoint in JDUtil._endpoint_dic:
+            JDUtil._endpoint_dic[endpoint] = base_url
+        JDUtil._in_path = None
+        JDUtil._host_concurrency = JDUtil._max_concurrency
+        JDUtil._host_rate = 0
+        session = JDUtil.FetchSession()
+        sku_ids = []
+        for idx in range(0, sku_count):
+            sku_ids.append(str((990000 if idx % 10 == 0 else 100000) + idx))
+        for label in ('first', 'cached'):
+            stat = get_server_stat(port)
+            op = time.time()
+            result = JDUtil.check_sku_ids(session, sku_ids)
+            check_time = time.time() - op
+            count = get_server_stat(port)['requests'] - stat['requests']
+            invalid = len([sku_id for sku_id in result if not result[sku_id]])
+            print('%-8s %8d %10d %8d %10.2f' % (label, sku_count, count, invalid, check_time))
+    finally:
+        server.kill()
+
+
+def get_imported_modules(args, cwd, env):
+    # 使用 -X importtime 列出命令加载的模块
+    output = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=cwd, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE).stderr.decode('utf-8', 'replace')
+    modules = set()
+    for line in output.split('\n'):
+        if line.startswith('import time:') and line.count('|') == 2:
+            modules.add(line.split('|')[2].strip())
+    return modules
+
+
+def startup_main(run_count):
+    sys.path.insert(0, _base_dir)
+    import JDUtil
+    work_dir = tempfile.mkdtemp()
+    in_path = os.path.join(work_dir, 'in.txt')
+    with open(in_path, 'w') as fp:
+        for idx in range(0, 1000):
+            fp.write('https://item.jd.com/%d.html\n' % (100000 + idx))
+    # 已经检查过的商品, 添加时不需要联网
+    session = JDUtil.FetchSession(in_path=in_path)
+    JDUtil.store_sku_checks(session, [('200000', 1, time.time())])
+    session.close()
+    env = dict(os.environ, PYTHONPATH=_base_dir)
+    # 直接运行脚本时每次都要重新编译, 使用 -m 时可以使用编译的缓存
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', os.path.join(_base_dir, 'JDUtil.py')])
+    commands = [
+        ('import', ['-c', 'import JDUtil']),
+        ('-A', ['-m', 'JDUtil', '-I=' + in_path, '-A=200000']),
+        ('-R', ['-m', 'JDUtil', '-I=' + in_path, '-R=200000']),
+        ('-H', ['-m', 'JDUtil', '-I=' + in_path, '-H=100000']),
+        ('-export', ['-m', 'JDUtil', '-I=' + in_path, '-export=' + os.path.join(work_dir, 'export.txt')]),
+        ('script', [os.path.join(_base_dir, 'JDUtil.py'), '-I=' + in_path, '-R=200000'])
+    ]
+    print('%-8s %10s %10s  %s' % ('command', 'median(ms)', 'min(ms)', 'network modules'))
+    for name, args in commands:
+        times = []
+        for idx in range(0, run_count):
+            op = time.time()
+            subprocess.run([sys.executable] + args, cwd=work_dir, env=env, stdout=subprocess.DEVNULL)
+            times.append((time.time() - op) * 1000)
+        times.sort()
+        modules = get_imported_modules(args, work_dir, env)
+        loaded = [module for module in _network_modules if module in modules]
+        print('%-8s %10.1f %10.1f  %s' % (name, times[len(times) // 2], times[0], ', '.join(loaded) or '-'))
+
+
+def get_parse_payloads(replay_path):
+    # 返回 {类型: [响应的字节]}, 有录制的内容时使用录制的内容, 否则使用模拟服务器生成的内容
+    import mock_server
+    payloads = {'prices': [], 'stock': [], 'coupon': []}
+    if replay_path is not None:
+        with open(replay_path, 'r', encoding='utf-8') as fp:
+            recordings = json.load(fp)
+        prices = list(recordings.get('price', {}).values())
+        for idx in range(0, len(prices), 50):
+            payloads['prices'].append(json.dumps(prices[idx:idx + 50]).encode('gbk'))
+        payloads['stock'] = [body.encode('gbk', 'replace') for body in recordings.get('stock', {}).values()]
+        payloads['coupon'] = [body.encode('gbk', 'replace') for body in recordings.get('coupon', {}).values()]
+    if not all(payloads.values()):
+        for idx in range(0, 20):
+            sku_ids = [str(100000 + idx * 50 + offset) for offset in range(0, 50)]
+            payloads['prices'].append(mock_server.get_price_body({'skuIds': [','.join(sku_ids)]})[0].encode('gbk'))
+            # 真实的库存接口在 stock 中还会返回配送, 服务等很多信息
+            stock = json.loads(mock_server.get_stock_body({'skuId': [sku_ids[0]]})[0])
+            stock_desc = stock['stock'].pop('stockDesc')
+            stock['stock'].update({'area': {'provinceName': '北京', 'cityName': '朝阳区', 'countyName': '三环以内'},
+                                   'serviceInfo': '由 京东 发货, 并提供售后服务. 11:00前完成下单, 预计今天送达',
+                                   'promiseResult': '<b>23:10</b>前下单, 预计<b>明天</b>送达', 'stockState': 33,
+                                   'StockStateName': '现货', 'weightValue': '0.15kg', 'rn': -1, 'stockDesc': stock_desc,
+                                   'support': [{'id': 'ypc', 'showName': '延保服务', 'helpLink': '//help.jd.com'}] * 4,
+                                   'eir': [{'iconTip': '可配送全球', 'iconCode': 'service_qqsh'}] * 4})
+            stock.update({'choseSuit': [], 'dcashDesc': '京东将为您免费上门取件' * 8, 'isJDexpress': 'true'})
+            payloads['stock'].append(json.dumps(stock, ensure_ascii=False).encode('gbk'))
+            # 真实的优惠券接口还会返回很多促销信息
+            coupon = json.loads(mock_server.get_coupon_body({'skuId': [str(100002 + idx * 3)]})[0])
+            coupon['prom'] = {'tags': [{'name': '满减', 'content': '满%d减%d' % (tag * 100, tag * 10)}
+                                       for tag in range(1, 40)]}
+            payloads['coupon'].append(json.dumps(coupon, ensure_ascii=False).encode('gbk'))
+    return payloads
+
+
+def parse_prices_json(contents):
+    prices = {}
+    for obj in json.loads(contents):
+        if 'id' in obj and 'p' in obj:
+            sku_id = str(obj['id'])
+            prices[sku_id[sku_id.find('_') + 1:]] = obj['p']
+    return prices
+
+
+def parse_stock_json(contents):
+    import JDUtil
+    obj = json.loads(contents)
+    if 'stock' not in obj or 'stockDesc' not in obj['stock']:
+        return ''
+    return JDUtil.regex_result(JDUtil._double_byte_rule, obj['stock']['stockDesc'], True, ':')
+
+
+def parse_coupon_json(contents):
+    obj = json.loads(contents)
+    if 'skuCoupon' not in obj or len(obj['skuCoupon']) == 0:
+        return ''
+    return ', '.join(str(info['quota']) + '-' + str(info['discount']) for info in obj['skuCoupon'])
+
+
+def parse_main(run_count, replay_path):
+    # 比较先解码再完整解析 json 与直接在字节中查找所需字段的速度, 单位为每个响应的微秒数
+    sys.path.insert(0, _base_dir)
+    import JDUtil
+    payloads = get_parse_payloads(replay_path)
+    parsers = {'prices': (parse_prices_json, JDUtil.parse_product_prices),
+               'stock': (parse_stock_json, JDUtil.parse_product_stock),
+               'coupon': (parse_coupon_json, JDUtil.parse_product_coupon)}
+    print('%-8s %10s %10s %14s %14s %8s' % ('kind', 'responses', 'bytes', 'json(us)', 'bytes(us)', 'speedup'))
+    for kind in parsers:
+        json_parser, bytes_parser = parsers[kind]
+        for data in payloads[kind]:
+            if json_parser(data.decode('gb18030')) != bytes_parser(data, 'gb18030'):
+                raise RuntimeError('解析结果不同: ' + data.decode('gb18030'))
+        times = []
+        for parser in (lambda data: json_parser(data.decode('gb18030')), lambda data: bytes_parser(data, 'gb18030')):
+            op = time.perf_counter()
+            for idx in range(0, run_count):
+                for data in payloads[kind]:
+                    parser(data)
+            times.append((time.perf_counter() - op) / run_count / len(payloads[kind]) * 1000000)
+        size = sum(len(data) for data in payloads[kind]) // len(payloads[kind])
+        print('%-8s %10d %10d %14.2f %14.2f %7.1fx' % (kind, len(payloads[kind]), size, times[0], times[1],
+                                                      times[0] / times[1]))
+
+
+def get_change_times(sku_id, horizon):
+    # 按泊松过程生成商品各项信息在 [0, horizon) 内变化的时间, 5% 的商品变化频繁
+    rng = random.Random(int(sku_id))
+    if int(sku_id) % 20 == 0:
+        rates = {'price': 3600, 'stock': 6 * 3600, 'coupon': 12 * 3600}
+    else:
+        rates = {'price': 10 * 86400, 'stock': 30 * 86400, 'coupon': 7 * 86400}
+    changes = {}
+    for field in rates:
+        times = []
+        change_time = rng.expovariate(1 / rates[field])
+        while change_time < horizon:
+            times.append(change_time)
+            change_time += rng.expovariate(1 / rates[field])
+        changes[field] = times
+    return changes
+
+
+def simulate_schedule(JDUtil, sku_count, budget, adaptive, tick=300, days=3):
+    # 不发出请求, 按模拟的时间推进持续监控. 前面的天数用于积累变化记录, 只统计最后一天.
+    # 返回 (平均每分钟的请求数, 所有变化的平均发现延迟, 频繁变化的商品价格的平均发现延迟), 延迟单位为分钟
+    horizon = days * 86400
+    measure_start = horizon - 86400
+    sku_ids = [str(100000 + idx) for idx in range(0, sku_count)]
+    changes = dict((sku_id, get_change_times(sku_id, horizon)) for sku_id in sku_ids)
+    fields = ('price', 'stock', 'coupon')
+    session = JDUtil.FetchSession(in_path=None, fetch_fields=list(fields), sku_attr_dic={}, watch_interval=tick)
+    JDUtil._alert_rules = {'price': {}, 'stock': {}, 'coupon': {}}
+    JDUtil._change_stats = {}
+    JDUtil._request_budget = budget
+    if not adaptive:
+        # 所有信息使用相同的间隔, 平均每分钟的请求数与预算相同
+        interval = max(tick, sku_count * (1 / session.price_batch_size + 2) * 60 / budget)
+        session.refresh_intervals = dict(((sku_id, field), interval) for sku_id in sku_ids for field in fields)
+    seen = {}
+    rng = random.Random(0)
+    requests = 0
+    delays = []
+    volatile_delays = []
+    for step in range(0, horizon // tick):
+        now = step * tick
+        if adaptive and step % 12 == 0:
+            JDUtil.schedule_refresh(session, sku_ids)
+        prices = 0
+        for sku_id in sku_ids:
+            for field in fields:
+                if not JDUtil.is_field_due(session, sku_id, field, now):
+                    continue
+                times = changes[sku_id][field]
+                version = bisect.bisect_right(times, now)
+                for change_time in times[seen.get((sku_id, field), 0):version]:
+                    if change_time >= measure_start:
+                        delays.append(now - change_time)
+                        if field == 'price' and int(sku_id) % 20 == 0:
+                            volatile_delays.append(now - change_time)
+                seen[(sku_id, field)] = version
+                # 与真实的查询一样, 更新时间为查询完成的时间, 晚于这一轮开始的时间
+                updated = now + rng.uniform(0, tick / 10)
+                session.field_updated[(sku_id, field)] = updated
+                if adaptive:
+                    JDUtil.update_change_stats(sku_id, field, version, updated)
+                if field == 'price':
+                    prices += 1
+                elif now >= measure_start:
+                    requests += 1
+        if now >= measure_start:
+            requests += (prices + session.price_batch_size - 1) // session.price_batch_size
+    return (requests / 1440, sum(delays) / max(1, len(delays)) / 60,
+            sum(volatile_delays) / max(1, len(volatile_delays)) / 60)
+
+
+def schedule_main(sku_count, budget):
+    # 比较相同预算下所有信息使用相同的刷新间隔, 以及按变化频率分配刷新间隔时发现变化的速度
+    sys.path.insert(0, _base_dir)
+    import JDUtil
+    print('%-9s %8s %8s %12s %12s %16s' % ('policy', 'skus', 'budget', 'requests/m', 'delay(min)',
+                                           'volatile(min)'))
+    for policy, count in (('fixed', sku_count), ('adaptive', sku_count), ('adaptive', sku_count * 10)):
+        op = time.time()
+        result = simulate_schedule(JDUtil, count, budget, policy == 'adaptive')
+        print('%-9s %8d %8d %12.1f %12.1f %16.1f  (%.1fs)' % ((policy, count, budget) + result +
+                                                              (time.time() - op,)))
+
+
+def get_options(argv):
+    options = dict(_options)
+    for arg in argv:
+        if arg.startswith('-') and arg.find('=') != -1:
+            key, value = arg[1:].split('=', 1)
+            options[key] = value
+    return options
+
+
+def main():
+    options = get_options(sys.argv[1:])
+    port = get_free_port()
+    concurrency = int(options['concurrency'])
+    server = start_mock_server(port, options)
+    try:
+        print('%-8s %8s %8s %10s %8s %10s %12s %10s %8s' % ('engine', 'workers', 'skus', 'requests', 'errors',
+                                                            'time(s)', 'requests/s', 'peak(MB)', 'missing'))
+        for sku_count in [int(size) for size in options['sizes'].split(',')]:
+            for engine in options['engines'].split(','):
+                for workers in [int(workers) for workers in options['workers'].split(',')]:
+                    stat = get_server_stat(port)
+                    result = run_child(engine, sku_count, port, concurrency, workers)
+                    current = get_server_stat(port)
+                    count = current['requests'] - stat['requests']
+                    errors = current['errors'] + current['drops'] - stat['errors'] - stat['drops']
+                    print('%-8s %8d %8d %10d %8d %10.2f %12.1f %10.1f %8d' % (
+                        engine, workers, sku_count, count, errors, result['wall_time'], count / result['wall_time'],
+                        result['peak_memory'], result['missing']))
+    finally:
+        server.kill()
+
+
+if __name__ == '__main__':
+    if any(arg.startswith('-render=') for arg in sys.argv):
+        render_main(int(get_options(sys.argv[1:])['render']))
+    elif any(arg.startswith('-parse=') for arg in sys.argv):
+        parse_options = get_options(sys.argv[1:])
+        parse_main(int(parse_options['parse']), parse_options['replay'])
+    elif any(arg.startswith('-schedule=') for arg in sys.argv):
+        schedule_options = get_options(sys.argv[1:])
+        schedule_main(int(schedule_options['schedule']), int(schedule_options.get('budget', '30')))
+    elif any(arg.startswith('-startup=') for arg in sys.argv):
+        startup_main(int(get_options(sys.argv[1:])['startup']))
+    elif any(arg.startswith('-check=') for arg in sys.argv):
+        check_options = get_options(sys.argv[1:])
+        print('%-8s %8s %10s %8s %10s' % ('run', 'skus', 'requests', 'invalid', 'time(s)'))
+        check_main(int(check_options['check']), check_options)
+    elif '-child' in sys.argv:
+        child_options = get_options(sys.argv[1:])
+        child_main(child_options['engine'], int(child_options['sku_count']), int(child_options['port']),
+                   int(child_options['concurrency']), int(child_options['workers']))
+    else:
+        main()
@@ -0,0 +1,259 @@
+import gzip
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+# 模拟京东的价格, 库存, 优惠券, 区域以及商品页面接口, 用于在本地测试和测试性能.
+# 用法: python mock_server.py [-port=8000] [-latency=毫秒] [-jitter=毫秒] [-error_rate=0.01] [-drop_rate=0.01]
+#       [-replay=recordings.json]
+# 录制真实接口的返回: python mock_server.py -record=recordings.json -skus=100012,100013 [-area=16_1315_1316_53522]
+
+# 每个请求的延迟为 _latency 加上 [0, _jitter] 之间的随机值(毫秒)
+_latency = 0
+_jitter = 0
+# 按比例返回 503, 或者不返回任何内容直接断开连接
+_error_rate = 0
+_drop_rate = 0
+# 录制的返回 {类型: {key: 内容}}, 没有录制的请求使用生成的内容
+_recordings = {'price': {}, 'stock': {}, 'coupon': {}, 'area': {}, 'item': {}}
+_stat = {'requests': 0, 'errors': 0, 'drops': 0, 'replayed': 0, 'not_modified': 0}
+_stat_lock = threading.Lock()
+_page_padding = '<div class="p-padding">' + 'x' * 2048 + '</div>\n'
+# 以此开头的 sku_id 视为不存在的商品: 价格为 -1.00, 商品页面重定向到首页
+_invalid_prefix = '99'
+
+
+def add_stat(key):
+    with _stat_lock:
+        _stat[key] += 1
+
+
+def get_recording(kind, key):
+    if key in _recordings[kind]:
+        add_stat('replayed')
+        return _recordings[kind][key]
+    return None
+
+
+def get_price_body(query):
+    sku_ids = query.get('skuIds', [''])[0].split(',')
+    prices = []
+    for sku_id in sku_ids:
+        if not sku_id.isdigit():
+            continue
+        recording = get_recording('price', sku_id)
+        if recording is not None:
+            prices.append(recording)
+            continue
+        price = '%d.%02d' % (int(sku_id) % 5000 + 1, int(sku_id) % 100)
+        if sku_id.startswith(_invalid_prefix):
+            price = '-1.00'
+        prices.append({'id': 'J_' + sku_id, 'p': price, 'm': price, 'op': price})
+    return json.dumps(prices), 'application/json;charset=gbk'
+
+
+def get_stock_body(query):
+    sku_id = query.get('skuId', ['0'])[0]
+    recording = get_recording('stock', sku_id + '|' + query.get('area', [''])[0])
+    if recording is not None:
+        return recording, 'application/json;charset=gbk'
+    if not sku_id.isdigit():
+        return '{}', 'application/json;charset=gbk'
+    if int(sku_id) % 3 == 0:
+        stock_desc = '<strong>无货</strong>，此商品暂时售完'
+    else:
+        stock_desc = '<strong>有货</strong>，下单后立即发货'
+    return json.dumps({'stock': {'skuId': sku_id, 'stockDesc': stock_desc}}, ensure_ascii=False), \
+        'application/json;charset=gbk'
+
+
+def get_coupon_body(query):
+    sku_id = query.get('skuId', ['0'])[0]
+    recording = get_recording('coupon', sku_id + '|' + query.get('area', [''])[0])
+    if recording is not None:
+        return recording, 'application/json;charset=gbk'
+    if not sku_id.isdigit():
+        return '{}', 'application/json;charset=gbk'
+    coupons = []
+    for idx in range(0, int(sku_id) % 3):
+        coupons.append({'quota': 100 * (idx + 1), 'discount': 10 * (idx + 1), 'couponType': 1})
+    return json.dumps({'skuCoupon': coupons, 'prom': {}}), 'application/json;charset=gbk'
+
+
+def get_area_body(query):
+    recording = get_recording('area', query.get('fid', ['0'])[0])
+    if recording is not None:
+        return recording, 'application/json;charset=gbk'
+    fid = int(query.get('fid', ['0'])[0])
+    # 只有三级区域
+    if fid >= 100000:
+        return '[]', 'application/json;charset=gbk'
+    areas = []
+    for idx in range(1, 6):
+        areas.append({'id': fid * 10 + idx, 'name': '区域%d' % (fid * 10 + idx)})
+    return json.dumps(areas, ensure_ascii=False), 'application/json;charset=gbk'
+
+
+def get_item_body(sku_id):
+    recording = get_recording('item', sku_id)
+    if recording is not None:
+        return recording, 'text/html;charset=gbk'
+    body = '<html><head><title>' + sku_id + '</title></head><body>\n' + _page_padding * 8 + \
+           '<div class="p-name">模拟商品 ' + sku_id + '</div>\n' + _page_padding * 64 + '</body></html>'
+    return body, 'text/html;charset=gbk'
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type, status=200):
+        data = body.encode('gbk', 'replace')
+        # 内容相同时 ETag 相同, 客户端带上 If-None-Match 时返回 304
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        if status == 200 and self.headers['If-None-Match'] == etag:
+            add_stat('not_modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        gzipped = 'gzip' in (self.headers['Accept-Encoding'] or '')
+        if gzipped:
+            data = gzip.compress(data, 5)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 200:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端读到需要的内容后可能提前关闭连接
+            pass
+
+    def do_GET(self):
+        url_info = parse.urlsplit(self.path)
+        query = parse.parse_qs(url_info.query)
+        if url_info.path == '/__stat':
+            self.send_body(json.dumps(_stat), 'application/json;charset=utf-8')
+            return
+        add_stat('requests')
+        if _latency > 0 or _jitter > 0:
+            time.sleep((_latency + random.uniform(0, _jitter)) / 1000)
+        if _drop_rate > 0 and random.random() < _drop_rate:
+            add_stat('drops')
+            self.close_connection = True
+            return
+        if _error_rate > 0 and random.random() < _error_rate:
+            add_stat('errors')
+            self.send_body('service unavailable', 'text/plain;charset=gbk', 503)
+            return
+        if url_info.path == '/prices/mgets':
+            body, content_type = get_price_body(query)
+        elif url_info.path == '/stock':
+            body, content_type = get_stock_body(query)
+        elif url_info.path == '/promotion/v2':
+            body, content_type = get_coupon_body(query)
+        elif url_info.path == '/area/get':
+            body, content_type = get_area_body(query)
+        elif url_info.path.endswith('.html') and url_info.path[1:-5].startswith(_invalid_prefix):
+            self.send_response(302)
+            self.send_header('Location', '/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        elif url_info.path.endswith('.html') and url_info.path[1:-5].isdigit():
+            body, content_type = get_item_body(url_info.path[1:-5])
+        else:
+            self.send_body('not found', 'text/plain;charset=gbk', 404)
+            return
+        self.send_body(body, content_type)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+
+def load_recordings(path):
+    with open(path, 'r', encoding='utf-8') as fp:
+        recordings = json.load(fp)
+    for kind in _recordings:
+        _recordings[kind].update(recordings.get(kind, {}))
+
+
+def record_responses(path, sku_ids, area_code):
+    # 使用 JDUtil 请求真实的接口, 保存为 load_recordings 可以读取的格式
+    import JDUtil
+    session = JDUtil.FetchSession(in_path=None)
+    recordings = {'price': {}, 'stock': {}, 'coupon': {}, 'area': {}, 'item': {}}
+    for batch in JDUtil.split_list(sku_ids, session.price_batch_size):
+        for obj in json.loads(JDUtil.get_html_content(session, JDUtil.get_price_url(session, batch), 'price')):
+            recordings['price'][str(obj['id']).split('_')[-1]] = obj
+    for sku_id in sku_ids:
+        key = sku_id + '|' + area_code
+        url = JDUtil.get_stock_url(session, sku_id, area_code)
+        recordings['stock'][key] = JDUtil.get_html_content(session, url, 'stock')
+        url = JDUtil.get_coupon_url(session, sku_id, area_code)
+        recordings['coupon'][key] = JDUtil.get_html_content(session, url, 'coupon')
+        recordings['item'][sku_id] = JDUtil.get_html_content(session, JDUtil.get_name_url(session, sku_id), 'name')
+    area_id = '0'
+    for child_id in area_code.split('_'):
+        url = JDUtil.get_area_url(session, area_id)
+        recordings['area'][area_id] = JDUtil.get_html_content(session, url, 'area')
+        area_id = child_id
+    with open(path, 'w', encoding='utf-8') as fp:
+        json.dump(recordings, fp, ensure_ascii=False)
+    return recordings
+
+
+def start_server(port=0, latency=0, jitter=0, error_rate=0, drop_rate=0, replay_path=None):
+    global _latency, _jitter, _error_rate, _drop_rate
+    _latency = latency
+    _jitter = jitter
+    _error_rate = error_rate
+    _drop_rate = drop_rate
+    if replay_path is not None:
+        load_recordings(replay_path)
+    server = MockServer(('127.0.0.1', port), MockHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    options = {'port': '8000', 'latency': '0', 'jitter': '0', 'error_rate': '0', 'drop_rate': '0', 'replay': None,
+               'record': None, 'skus': '', 'area': '16_1315_1316_53522'}
+    for arg in sys.argv[1:]:
+        if arg.startswith('-') and arg.find('=') != -1:
+            key, value = arg[1:].split('=', 1)
+            options[key] = value
+    if options['record'] is not None:
+        recorded = record_responses(options['record'], [sku_id for sku_id in options['skus'].split(',') if sku_id],
+                                    options['area'])
+        print('已录制:', ', '.join('%s %d' % (kind, len(recorded[kind])) for kind in recorded))
+        sys.exit(0)
+    mock_server = start_server(int(options['port']), int(options['latency']), int(options['jitter']),
+                               float(options['error_rate']), float(options['drop_rate']), options['replay'])
+    print('模拟服务器已启动: http://127.0.0.1:%d' % mock_server.server_address[1])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock_server.shutdown()
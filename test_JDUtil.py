@@ -0,0 +1,194 @@
+# 直接在字节中查找价格, 库存和优惠券的解析结果必须与 simplejson 完整解析的结果相同. 运行: python -m unittest test_JDUtil
+import json
+import random
+import unittest
+
+import simplejson
+
+import JDUtil
+
+# gbk 中第二个字节与 \ 或者括号相同的汉字
+_trail_chars = [chr(code) for code in range(0x4e00, 0x9fa5)
+                if len(chr(code).encode('gbk', 'ignore')) == 2 and chr(code).encode('gbk')[1] in b'\\[]{}']
+
+
+def json_price(contents):
+    json_obj = simplejson.loads(contents)
+    if len(json_obj) == 0 or 'p' not in json_obj[0]:
+        return ''
+    return json_obj[0]['p']
+
+
+def json_prices(contents):
+    prices = {}
+    for obj in simplejson.loads(contents):
+        if 'id' not in obj or 'p' not in obj:
+            continue
+        sku_id = str(obj['id'])
+        prices[sku_id[sku_id.find('_') + 1:]] = obj['p']
+    return prices
+
+
+def json_stock_desc(contents):
+    json_obj = simplejson.loads(contents)
+    if 'stock' not in json_obj or 'stockDesc' not in json_obj['stock']:
+        return ''
+    return json_obj['stock']['stockDesc']
+
+
+def json_stock(contents):
+    desc = json_stock_desc(contents)
+    if desc == '':
+        return ''
+    return JDUtil.regex_result(JDUtil._double_byte_rule, desc, True, ':')
+
+
+def json_coupons(contents):
+    json_obj = simplejson.loads(contents)
+    if 'skuCoupon' not in json_obj or len(json_obj['skuCoupon']) == 0:
+        return []
+    return [str(info['quota']) + '-' + str(info['discount']) for info in json_obj['skuCoupon']]
+
+
+def json_coupon(contents):
+    return ', '.join(json_coupons(contents))
+
+
+def get_result(func, *args):
+    # 出错时只比较异常的类型
+    try:
+        return func(*args)
+    except Exception as e:
+        return type(e)
+
+
+def pad(contents):
+    # 很短的库存响应不走字节扫描, 在末尾补上空白
+    return contents + ' ' * 256
+
+
+class ParseBytesTest(unittest.TestCase):
+    def assert_parser(self, parser, reference, contents, encodings=('utf-8', 'gb18030')):
+        for encoding in encodings:
+            self.assertEqual(get_result(parser, contents.encode(encoding), encoding), get_result(reference, contents),
+                             (contents, encoding))
+
+    def assert_scan(self, scan, reference, contents, encodings=('utf-8', 'gb18030')):
+        # 字节扫描只能返回正确的结果, 或者返回 None 退回到完整解析
+        for encoding in encodings:
+            data, scan_encoding = JDUtil.get_scan_bytes(contents.encode(encoding), encoding)
+            result = scan(data, scan_encoding)
+            if result is not None:
+                self.assertEqual(result, get_result(reference, contents), (contents, encoding))
+
+    def assert_stock(self, contents):
+        self.assert_parser(JDUtil.parse_product_stock, json_stock, pad(contents))
+        self.assert_scan(JDUtil.parse_stock_bytes, json_stock_desc, contents)
+
+    def assert_coupon(self, contents):
+        self.assert_parser(JDUtil.parse_product_coupon, json_coupon, contents)
+        self.assert_scan(JDUtil.parse_coupon_bytes, json_coupons, contents)
+
+    def assert_prices(self, contents):
+        self.assert_parser(JDUtil.parse_product_price, json_price, contents)
+        self.assert_parser(JDUtil.parse_product_prices, json_prices, contents)
+
+    def test_prices(self):
+        for contents in ['[]', '[{"id":"J_1","p":"1.00"}]', '[{"p":"2.00","id":"J_2"}]', '[{"id":"J_1"}]',
+                         '[{"p":"3"}]', '[{"id":3,"p":"4"}]', '[{"id":"J_1","p":4.5}]', '{"error":"x"}',
+                         '[{"id":"J_1","p":"5","x":{"a":1}}]', '[{"id":"J_1","name":"a{b","p":"6"}]',
+                         ' [ { "id" : "J_9" , "p" : "-1.00" } ]', '[{"op":"1","id":"J_5"}]',
+                         '[{"id":"J_1","p":"1","n":"中文\\\\{"}]', '[{"id":"J_\\u0031","p":"1"}]']:
+            self.assert_prices(contents)
+
+    def test_nested_stock_desc(self):
+        for contents in ['{}', '{"stock":{}}', '{"stock":null}', '{"stock":"stockDesc"}',
+                         '{"stock":{"stockDesc":"<strong>有货</strong>，下单后立即发货"}}',
+                         '{"stock":{"stockDesc":"<strong>预订</strong>预计 12 天"}}',
+                         '{"stockDesc":"<strong>有货</strong>"}',
+                         '{"stockDesc":"<strong>无货</strong>","stock":{}}',
+                         '{"stock":{"stockDesc":"a"},"x":{"stockDesc":"b"}}',
+                         '{"x":{"stock":{"stockDesc":"<strong>有货</strong>"}}}',
+                         '{"stock":{"a":{"stockDesc":"<strong>有货</strong>"}}}',
+                         '{"stock":{"a":{"stockDesc":"<strong>无货</strong>"},"stockDesc":"<strong>有货</strong>"}}',
+                         '{"stock":{"stockDesc":"<strong>有货</strong>","stockDesc":"<strong>无货</strong>"}}',
+                         '{"stock":{"stockDesc":"<strong>有货</strong>"},"stock":{}}',
+                         '{"stock":{"stockDesc":5}}', '{"stock":{"stockDesc":null}}',
+                         '{"stock":{"x":"}","stockDesc":"<strong>有货</strong>"}}',
+                         '{"a":"\\"stock\\": {","stock":{"stockDesc":"<strong>有货</strong>"}}',
+                         '[{"stock":{"stockDesc":"<strong>有货</strong>"}}]',
+                         '{"stock":{"skuId":"1","stockDesc":"<strong>\\u65e0\\u8d27</strong>\\"x\\" 3 天"}}']:
+            self.assert_stock(contents)
+
+    def test_nested_quota(self):
+        for contents in ['{}', '{"skuCoupon":[]}', '{"skuCoupon":null}',
+                         '{"skuCoupon":[{"quota":100,"discount":10,"couponType":1}],"prom":{}}',
+                         '{"skuCoupon":[{"quota":"199","discount":20.50},{"quota":1e3,"discount":-5}]}',
+                         '{"skuCoupon":[{"quota":100}]}', '{"skuCoupon":[{"quota":100,"discount":10}',
+                         '{"skuCoupon":[{"x":{"quota":9},"quota":1,"discount":2}]}',
+                         '{"skuCoupon":[{"quota":1,"discount":2,"t":[{"quota":5}]}]}',
+                         '{"skuCoupon":[{"quota":{"a":1},"discount":2}]}',
+                         '{"skuCoupon":[{"quota":1,"discount":2,"quota":3}]}',
+                         '{"a":{"skuCoupon":[{"quota":1,"discount":2}]}}',
+                         '{"prom":{"quota":1},"skuCoupon":[{"discount":3,"quota":30}]}',
+                         '{"skuCoupon":[{"name":"满减]{","quota":100,"discount":5,"ext":{"a":[1,{"b":2}]}}]}',
+                         '{"skuCoupon":[{"quota":1,"discount":2}],"skuCoupon":[]}',
+                         '{"skuCoupon":[{"quota":"满\\"100","discount":"减10"}]}']:
+            self.assert_coupon(contents)
+
+    def test_escaped_keys(self):
+        self.assert_stock('{"stock":{"stock\\u0044esc":"<strong>有货</strong>"}}')
+        self.assert_stock('{"\\u0073tock":{"stockDesc":"<strong>有货</strong>"}}')
+        self.assert_stock('{"stock":{"stockDesc":"<strong>无货</strong>","stock\\u0044esc":"<strong>有货</strong>"}}')
+        self.assert_coupon('{"skuCoupon":[{"quot\\u0061":1,"discount":2}]}')
+        self.assert_coupon('{"skuCoupon":[{"quota":1,"discount":2,"quot\\u0061":3}]}')
+        self.assert_coupon('{"sku\\u0043oupon":[{"quota":1,"discount":2}]}')
+        self.assert_coupon('{"skuCoupon":[{"quota":1,"discount":2}],"sku\\u0043oupon":[]}')
+        self.assert_stock('{"stock":{"stockDesc":"<strong>有货</strong>"},"\\u0073tock":{}}')
+        self.assert_prices('[{"id":"J_1","p":"1","\\u0070":"2"}]')
+        self.assert_prices('[{"id":"J_1","p":"1","\\u0069d":"J_2"}]')
+        # 值中的转义不影响按字节查找
+        data = b'{"stock":{"stockDesc":"<strong>\\u6709\\u8d27</strong>"}}'
+        self.assertEqual(JDUtil.parse_stock_bytes(data, 'utf-8'), '<strong>有货</strong>')
+
+    def test_gbk_trail_bytes(self):
+        self.assertTrue(_trail_chars)
+        for char in _trail_chars:
+            self.assert_stock('{"stock":{"stockDesc":"<strong>%s货</strong>，%s 3 天"}}' % (char, char))
+            self.assert_stock('{"%s":"%s","stock":{"stockDesc":"<strong>%s</strong>"}}' % (char, char, char))
+            self.assert_coupon(json.dumps({'skuCoupon': [{'quota': char + '"' + char, 'discount': 1.5}],
+                                           'prom': {char: [char]}}, ensure_ascii=False))
+            self.assert_coupon(json.dumps({char: char, 'skuCoupon': [{'name': char, 'quota': 1, 'discount': 2}]},
+                                          ensure_ascii=False))
+            self.assert_prices(json.dumps([{'id': 'J_1', 'p': '1', 'n': char}, {'id': 'J_2', 'p': char}],
+                                          ensure_ascii=False))
+
+    def test_non_object_array_elements(self):
+        for contents in ['{"skuCoupon":[1]}', '{"skuCoupon":["a"]}', '{"skuCoupon":[null]}', '{"skuCoupon":[[]]}',
+                         '{"skuCoupon":[{"quota":1,"discount":2},3]}', '{"skuCoupon":[3,{"quota":1,"discount":2}]}',
+                         '{"skuCoupon":[{"quota":1,"discount":2},[{"quota":3,"discount":4}]]}',
+                         '{"skuCoupon":[{"quota":1,"discount":2} "x"]}']:
+            self.assert_coupon(contents)
+
+    def test_random_documents(self):
+        rng = random.Random(5)
+        names = ['stock', 'stockDesc', 'quota', 'discount', 'skuCoupon', 'a'] + _trail_chars[:2]
+        values = [1, 2.5, '有货', 'x"y', '{[', None, True, '<strong>无货</strong>', 'ab\\c'] + _trail_chars[:2]
+
+        def random_value(depth):
+            r = rng.random()
+            if depth > 2 or r < 0.4:
+                return rng.choice(values)
+            if r < 0.7:
+                return [random_value(depth + 1) for idx in range(rng.randint(0, 3))]
+            return dict((rng.choice(names), random_value(depth + 1)) for idx in range(rng.randint(0, 4)))
+
+        for idx in range(1000):
+            keys = rng.sample(['stock', 'skuCoupon', 'a', 'prom'], rng.randint(1, 3))
+            contents = json.dumps(dict((key, random_value(1)) for key in keys), ensure_ascii=rng.random() < 0.5)
+            self.assert_stock(contents)
+            self.assert_coupon(contents)
+
+
+if __name__ == '__main__':
+    unittest.main()